@@ -0,0 +1,301 @@
+#! /usr/bin/env python
+#
+# Benchmark suite for the export pipeline.
+#
+# Generates synthetic Inkscape documents and times the stages of the extension on them:
+# get_layers, build_skeleton, clean_up_target_file, analyseNode (the workarounds and the
+# bounding box, as in clean_up_target_file), the bounding box engine alone (layer_bbox),
+# writeComponentsJson, writeHTML and a complete export. Inkscape itself is replaced by a stub that copies the
+# layer document, so the suite runs on any machine with inkex installed and only measures
+# the extension.
+#
+#   python benchmarks/bench_export.py                        all scenarios
+#   python benchmarks/bench_export.py --scenario text        one scenario
+#   python benchmarks/bench_export.py --layers 500 --nodes 20 --depth 3
+#   python benchmarks/bench_export.py --output results.json
+#   python benchmarks/bench_export.py --baseline benchmarks/baseline.json
+#
+# With --baseline, every timing is compared with the baseline and the run fails when one
+# of them is more than --max-slowdown times slower. Stages that take less than --min-seconds
+# in the baseline and now are only reported, their ratio is mostly noise.
+
+import argparse
+import base64
+import copy
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from svg_stencil_export import SVGStencilExporter, Options, BoundingBoxEngine
+
+SCENARIOS = {
+        "small":  {"layers": 20,  "nodes": 10, "depth": 1, "text_density": 0.0, "image_kb": 0,  "locked": 0},
+        "many":   {"layers": 300, "nodes": 10, "depth": 1, "text_density": 0.0, "image_kb": 0,  "locked": 5},
+        "nested": {"layers": 50,  "nodes": 20, "depth": 4, "text_density": 0.0, "image_kb": 0,  "locked": 0},
+        "text":   {"layers": 50,  "nodes": 40, "depth": 1, "text_density": 0.5, "image_kb": 0,  "locked": 0},
+        "images": {"layers": 50,  "nodes": 5,  "depth": 1, "text_density": 0.0, "image_kb": 64, "locked": 0},
+        }
+
+# Replaces inkscape: copies the layer document to the export target, for single
+# exports (--pipe) as well as for the shell mode
+STUB_INKSCAPE = '''#! {python}
+import shutil, sys
+args = sys.argv[1:]
+if "--shell" in args:
+    sys.stdout.write("> ")
+    sys.stdout.flush()
+    source = target = None
+    for line in sys.stdin:
+        if line.strip() == "quit":
+            break
+        for action in line.strip().split(";"):
+            name, _, value = action.partition(":")
+            if name == "file-open":
+                source = value
+            elif name == "export-filename":
+                target = value
+            elif name == "export-do":
+                shutil.copyfile(source, target)
+        sys.stdout.write("\\n> ")
+        sys.stdout.flush()
+elif "--pipe" in args:
+    sys.stdout.buffer.write(sys.stdin.buffer.read())
+'''
+
+
+def shape(i, depth):
+    x = (i * 7) % 500
+    y = (i * 13) % 500
+    element = '<path id="p{0}" d="M {1},{2} C {3},{4} {5},{6} {7},{8} Z" style="fill:#336699;stroke:#000000;stroke-width:1"/>'.format(
+            i, x, y, x + 10, y - 5, x + 20, y + 25, x + 30, y + 10)
+    for level in range(depth - 1):
+        element = '<g id="g{0}_{1}" transform="translate({1},0)">{2}</g>'.format(i, level + 1, element)
+    return element
+
+
+def text(i):
+    x = (i * 11) % 500
+    y = (i * 17) % 500
+    return '<text id="t{0}" x="{1}" y="{2}" style="font-size:8px"><tspan id="ts{0}" x="{1}" y="{2}">Label {0}</tspan></text>'.format(i, x, y)
+
+
+def image(i, image_data):
+    return '<image id="i{0}" x="{1}" y="{1}" width="32" height="32" xlink:href="data:image/png;base64,{2}"/>'.format(i, i % 400, image_data)
+
+
+def synthetic_document(layers, nodes, depth, text_density, image_kb, locked):
+    image_data = base64.b64encode(os.urandom(image_kb * 1024)).decode() if image_kb else None
+
+    body = []
+    element_number = 0
+    for layer in range(layers):
+        elements = []
+        for node in range(nodes):
+            element_number += 1
+            if node < nodes * text_density:
+                elements.append(text(element_number))
+            else:
+                elements.append(shape(element_number, depth))
+        if image_data:
+            elements.append(image(layer, image_data))
+
+        insensitive = ' sodipodi:insensitive="true"' if layer < locked else ''
+        body.append('<g inkscape:groupmode="layer" id="layer{0}" inkscape:label="Layer {0}"{1}>{2}</g>'.format(
+            layer, insensitive, "".join(elements)))
+
+    return '''<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" xmlns:inkscape="http://www.inkscape.org/namespaces/inkscape" xmlns:sodipodi="http://sodipodi.sourceforge.net/DTD/sodipodi-0.dtd" width="500mm" height="500mm" viewBox="0 0 500 500">
+  <defs id="defs1"><linearGradient id="gradient1"><stop offset="0" style="stop-color:#ff0000"/></linearGradient></defs>
+  <sodipodi:namedview id="namedview1" pagecolor="#ffffff"/>
+  {}
+</svg>'''.format("\n  ".join(body))
+
+
+def exporter_arguments(output_path, svg_path):
+    return [
+            "--path={}".format(output_path),
+            "--overwrite-files=true",
+            "--write-components=true",
+            "--create-cover-page=true",
+            "--workers=1",
+            # One stub process for the whole export, the suite measures the extension
+            "--use-inkscape-shell=true",
+            svg_path,
+            ]
+
+
+def load_exporter(output_path, svg_path):
+    exporter = SVGStencilExporter()
+    exporter.parse_arguments(exporter_arguments(output_path, svg_path))
+    exporter.load_raw()
+    exporter.clean_up()
+    return exporter
+
+
+def measure(repeat, function):
+    timings = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def run_scenario(name, config, repeat, work_dir):
+    scenario_dir = os.path.join(work_dir, name)
+    output_path = os.path.join(scenario_dir, "output")
+    os.makedirs(output_path)
+
+    svg_path = os.path.join(scenario_dir, "stencil.svg")
+    with open(svg_path, "w") as svg_file:
+        svg_file.write(synthetic_document(**config))
+
+    results = {}
+
+    # Each measurement gets a fresh document, get_layers adds the start rects of locked layers
+    def get_layers():
+        exporter = load_exporter(output_path, svg_path)
+        start = time.perf_counter()
+        exporter.get_layers()
+        return time.perf_counter() - start
+    results["get_layers"] = statistics.median(get_layers() for i in range(repeat))
+
+    exporter = load_exporter(output_path, svg_path)
+    layers = exporter.get_layers()
+    layer_ids = [layer.id for layer in layers]
+    results["build_skeleton"] = measure(repeat, exporter.build_skeleton)
+    exporter.skeleton = exporter.build_skeleton()
+
+    def clean_up_target_files():
+        for layer_id in layer_ids:
+            exporter.clean_up_target_file(layer_id)
+    results["clean_up_target_file"] = measure(repeat, clean_up_target_files)
+
+    # The analyseNode stage of clean_up_target_file: the workarounds of analyseNode/getMaxGeo
+    # and the bounding box, on copies of the layers, the workarounds change the nodes
+    def analyse_nodes():
+        BoundingBoxEngine.cache.clear()
+        for layer_id in layer_ids:
+            record = exporter.layer_index.by_id[layer_id]
+            layer = copy.deepcopy(record.element)
+            exporter.svg.append(layer)
+            children = list(layer.iterchildren())
+            for node in children:
+                exporter.analyseNode(node, len(children))
+            BoundingBoxEngine().layer_bbox(layer, record.transform)
+            exporter.svg.remove(layer)
+    results["analyseNode"] = measure(repeat, analyse_nodes)
+
+    # The bounding box engine alone on every layer, without the boxes of earlier runs
+    def layer_bboxes():
+        BoundingBoxEngine.cache.clear()
+        for layer_id in layer_ids:
+            record = exporter.layer_index.by_id[layer_id]
+            BoundingBoxEngine().layer_bbox(record.element, record.transform)
+    results["layer_bbox"] = measure(repeat, layer_bboxes)
+
+    options = Options(exporter)
+    components_list = ["{}_{}.svg".format(number + 1, layer.label) for (number, layer) in enumerate(layers)]
+    components_data = {}
+    for file_name in components_list:
+        components_data[file_name] = {"type": "component", "top": 1.0, "bottom": 2.0, "left": 3.0, "right": 4.0, "translate_x": 0.0, "translate_y": 0.0}
+    results["writeComponentsJson"] = measure(repeat, lambda: exporter.writeComponentsJson(options, components_list, components_data))
+    results["writeHTML"] = measure(repeat, lambda: exporter.writeHTML(options, components_list))
+
+    # A complete export through the stub inkscape
+    def export():
+        shutil.rmtree(output_path)
+        os.makedirs(output_path)
+        exporter = SVGStencilExporter()
+        exporter.run(exporter_arguments(output_path, svg_path), output=os.devnull)
+    results["export"] = measure(repeat, export)
+
+    return {name: round(seconds, 6) for (name, seconds) in results.items()}
+
+
+def compare(results, baseline, max_slowdown, min_seconds):
+    failed = False
+    print("\n{:<10} {:<22} {:>10} {:>10} {:>8}".format("scenario", "stage", "baseline", "now", "ratio"))
+    for (scenario, timings) in results["scenarios"].items():
+        if scenario not in baseline.get("scenarios", {}):
+            continue
+        for (stage, seconds) in timings["timings"].items():
+            before = baseline["scenarios"][scenario]["timings"].get(stage)
+            if not before:
+                continue
+            ratio = seconds / before
+            slower = ratio > max_slowdown and max(before, seconds) >= min_seconds
+            marker = "  SLOWER" if slower else ""
+            if ratio > max_slowdown and not slower:
+                marker = "  (below {}s)".format(min_seconds)
+            failed = failed or slower
+            print("{:<10} {:<22} {:>10.4f} {:>10.4f} {:>7.2f}x{}".format(scenario, stage, before, seconds, ratio, marker))
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the SVG stencil export pipeline")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS), help="scenario to run, can be repeated (default: all)")
+    parser.add_argument("--layers", type=int, help="custom scenario: number of layers")
+    parser.add_argument("--nodes", type=int, default=10, help="custom scenario: nodes per layer")
+    parser.add_argument("--depth", type=int, default=1, help="custom scenario: group nesting depth of the nodes")
+    parser.add_argument("--text-density", type=float, default=0.0, help="custom scenario: share of the nodes that are text")
+    parser.add_argument("--image-kb", type=int, default=0, help="custom scenario: size of the embedded image in every layer")
+    parser.add_argument("--locked", type=int, default=0, help="custom scenario: number of locked layers")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per measurement, the median is reported")
+    parser.add_argument("--output", help="write the results to this json file")
+    parser.add_argument("--baseline", help="compare with the results in this json file")
+    parser.add_argument("--max-slowdown", type=float, default=1.5, help="fail when a stage is this much slower than the baseline")
+    parser.add_argument("--min-seconds", type=float, default=0.005, help="stages faster than this aren't compared, only reported")
+    args = parser.parse_args()
+
+    if args.layers:
+        scenarios = {"custom": {"layers": args.layers, "nodes": args.nodes, "depth": args.depth,
+                                "text_density": args.text_density, "image_kb": args.image_kb, "locked": args.locked}}
+    else:
+        scenarios = {name: SCENARIOS[name] for name in (args.scenario or sorted(SCENARIOS))}
+
+    work_dir = tempfile.mkdtemp(prefix="stencil-bench-")
+    bin_dir = os.path.join(work_dir, "bin")
+    os.makedirs(bin_dir)
+    stub_path = os.path.join(bin_dir, "inkscape")
+    with open(stub_path, "w") as stub_file:
+        stub_file.write(STUB_INKSCAPE.format(python=sys.executable))
+    os.chmod(stub_path, 0o755)
+    os.environ["PATH"] = bin_dir + os.pathsep + os.environ.get("PATH", "")
+
+    results = {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "repeat": args.repeat,
+            "scenarios": {},
+            }
+
+    try:
+        for (name, config) in scenarios.items():
+            timings = run_scenario(name, config, args.repeat, work_dir)
+            results["scenarios"][name] = {"config": config, "timings": timings}
+            print("{:<10} ".format(name) + "  ".join("{} {:.4f}s".format(stage, seconds) for (stage, seconds) in timings.items()))
+    finally:
+        shutil.rmtree(work_dir)
+
+    if args.output:
+        with open(args.output, "w") as json_file:
+            json.dump(results, json_file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as json_file:
+            baseline = json.load(json_file)
+        if compare(results, baseline, args.max_slowdown, args.min_seconds):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
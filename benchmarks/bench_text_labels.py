@@ -0,0 +1,84 @@
+#! /usr/bin/env python
+#
+# Regression benchmark for the text bounding box workaround in getMaxGeo.
+#
+# Builds layers with thousands of text labels and times what clean_up_target_file does
+# with them: the workarounds of analyseNode and the bounding box of the layer.
+# Every text element only looks at its own tspans, so the time per label has to
+# stay the same when the number of labels grows.
+#
+#   python benchmarks/bench_text_labels.py [--sizes 1000,2000,4000]
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from svg_stencil_export import SVGStencilExporter, BoundingBoxEngine
+
+# Allowed growth of the time per label between the smallest and largest size
+MAX_SLOWDOWN = 2.0
+
+
+def text_document(labels):
+    texts = []
+    for i in range(labels):
+        x = (i % 100) * 20
+        y = (i // 100) * 20
+        texts.append('<text id="text{0}" x="{1}" y="{2}" style="font-size:8px"><tspan id="tspan{0}" x="{1}" y="{2}">Label {0}</tspan></text>'.format(i, x, y))
+
+    return '''<svg xmlns="http://www.w3.org/2000/svg" xmlns:inkscape="http://www.inkscape.org/namespaces/inkscape" xmlns:sodipodi="http://sodipodi.sourceforge.net/DTD/sodipodi-0.dtd" width="2000" height="2000" viewBox="0 0 2000 2000">
+  <g inkscape:groupmode="layer" id="labels" inkscape:label="Labels">
+    {}
+  </g>
+</svg>'''.format("\n    ".join(texts))
+
+
+def time_labels(labels):
+    with tempfile.NamedTemporaryFile(suffix='.svg', delete=False) as svg_file:
+        svg_file.write(text_document(labels).encode())
+
+    try:
+        exporter = SVGStencilExporter()
+        exporter.parse_arguments([svg_file.name])
+        exporter.load_raw()
+        exporter.clean_up()
+    finally:
+        os.remove(svg_file.name)
+
+    layer = exporter.svg.getElementById("labels")
+    children = list(layer.iterchildren())
+    BoundingBoxEngine.cache.clear()
+
+    start = time.perf_counter()
+    for node in children:
+        exporter.analyseNode(node, len(children))
+    BoundingBoxEngine().layer_bbox(layer, layer.composed_transform())
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Text label bounding box benchmark")
+    parser.add_argument("--sizes", default="1000,2000,4000", help="comma separated numbers of text labels")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    per_label = {}
+    for labels in sizes:
+        elapsed = time_labels(labels)
+        per_label[labels] = elapsed / labels
+        print("{:>6} labels  {:8.3f} s  {:8.1f} us/label".format(labels, elapsed, per_label[labels] * 1e6))
+
+    slowdown = per_label[sizes[-1]] / per_label[sizes[0]]
+    print("slowdown per label from {} to {} labels: {:.2f}x".format(sizes[0], sizes[-1], slowdown))
+    if slowdown > MAX_SLOWDOWN:
+        print("FAIL: text bounding boxes don't scale linearly")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,193 @@
+#! /usr/bin/env python
+#
+# Correctness check for the path geometry of BoundingBoxEngine.
+#
+# The boxes of the engine are compared with boxes of points sampled along the path, worked
+# out here straight from the path commands of the SVG specification. Fixed paths cover the
+# smooth curve commands after other commands, random paths with random transforms the rest.
+# The engine box has to hold every sampled point and may only be larger by the sampling error.
+#
+#   python benchmarks/check_bbox_engine.py [--paths 500] [--seed 1]
+
+import argparse
+import io
+import os
+import random
+import re
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import inkex
+
+from svg_stencil_export import BoundingBoxEngine, numpy
+
+# Points sampled per segment, and the distance the engine box may be off by
+SAMPLES = 500
+TOLERANCE = 1e-3
+ARGUMENTS = {"M": 2, "L": 2, "H": 1, "V": 1, "C": 6, "S": 4, "Q": 4, "T": 2, "Z": 0}
+
+FIXED_PATHS = [
+        # T after a cubic curve reflects nothing, its control point is the current point
+        ("M 17 -22 c 20 -21 -6 -21 36 -22 T 8 -13 Z", None),
+        ("M 0 0 Q 10 20 20 0 T 40 0 S 60 20 70 0", None),
+        ("M 0 0 C 0 10 10 10 10 0 S 20 -10 20 0 t 10 10", None),
+        ("m 5 5 h 10 v 10 h -10 z m 20 0 l 5 5 5 -5", None),
+        ("M 0 0 C 0 1 1 1 1 0", "rotate(30)"),
+        ]
+
+# Cubic curves with a turn in one axis, none and in both
+CURVES = [
+        [(0, 0), (0, 1), (1, 1), (1, 0)],
+        [(0, 0), (1, 0), (2, 0), (3, 0)],
+        [(0, 0), (3, 3), (-2, 3), (1, 0)],
+        ]
+
+
+def sample_path(d):
+    """Points along the path, one segment at a time"""
+    tokens = re.findall(r'[A-Za-z]|[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?', d)
+    points = []
+    current = start = (0.0, 0.0)
+    # The command and last control point of the previous segment, for S and T
+    previous = (None, None)
+    letter = None
+    index = 0
+    while index < len(tokens):
+        if tokens[index].isalpha():
+            letter = tokens[index]
+            index += 1
+        absolute = letter.upper()
+        size = ARGUMENTS[absolute]
+        args = [float(token) for token in tokens[index:index + size]]
+        index += size
+
+        if absolute == 'Z':
+            current = start
+            points.append(current)
+            previous = ('Z', None)
+            continue
+
+        # Relative coordinates start at the current point
+        if absolute == 'H':
+            end = (args[0] + (current[0] if letter == 'h' else 0), current[1])
+        elif absolute == 'V':
+            end = (current[0], args[0] + (current[1] if letter == 'v' else 0))
+        else:
+            if letter.islower():
+                args = [value + current[i % 2] for (i, value) in enumerate(args)]
+            end = (args[-2], args[-1])
+
+        if absolute == 'M':
+            current = start = end
+            points.append(current)
+            previous = ('M', None)
+            # More coordinates after a moveto are linetos
+            letter = 'l' if letter == 'm' else 'L'
+            continue
+
+        if absolute in 'LHV':
+            curve = [current, end]
+        elif absolute == 'C':
+            curve = [current, (args[0], args[1]), (args[2], args[3]), end]
+        elif absolute == 'S':
+            first = reflect(current, previous[1]) if previous[0] in ('C', 'S') else current
+            curve = [current, first, (args[0], args[1]), end]
+        elif absolute == 'Q':
+            curve = [current, (args[0], args[1]), end]
+        else:
+            control = reflect(current, previous[1]) if previous[0] in ('Q', 'T') else current
+            curve = [current, control, end]
+
+        for step in range(SAMPLES + 1):
+            points.append(bezier(curve, step / SAMPLES))
+        current = end
+        previous = (absolute, curve[-2] if len(curve) > 2 else None)
+    return points
+
+
+def reflect(point, control):
+    return (2 * point[0] - control[0], 2 * point[1] - control[1])
+
+
+def bezier(curve, t):
+    """A point of a line, quadratic or cubic curve, by de Casteljau"""
+    while len(curve) > 1:
+        curve = [((1 - t) * a[0] + t * b[0], (1 - t) * a[1] + t * b[1]) for (a, b) in zip(curve, curve[1:])]
+    return curve[0]
+
+
+def random_path(generator):
+    commands = []
+    for index in range(generator.randint(1, 6)):
+        letter = generator.choice("MLHVCSQTZ" if index else "M")
+        if generator.random() < 0.5:
+            letter = letter.lower()
+        size = ARGUMENTS[letter.upper()]
+        commands.append(letter + " " + " ".join(str(generator.randint(-50, 50)) for i in range(size)))
+    return " ".join(commands)
+
+
+def random_transform(generator):
+    return generator.choice([
+            None,
+            "translate({},{})".format(generator.randint(-20, 20), generator.randint(-20, 20)),
+            "rotate({})".format(generator.randint(0, 359)),
+            "matrix({},{},{},{},{},{})".format(*(round(generator.uniform(-2, 2), 2) for i in range(6))),
+            ])
+
+
+def check_path(d, transform):
+    svg = '<svg xmlns="http://www.w3.org/2000/svg"><g id="layer"><path d="{}"/></g></svg>'.format(d)
+    layer = inkex.load_svg(io.BytesIO(svg.encode())).getroot()[0]
+    BoundingBoxEngine.cache.clear()
+    box = BoundingBoxEngine().layer_bbox(layer, inkex.Transform(transform))
+
+    matrix = inkex.Transform(transform)
+    points = [matrix.apply_to_point(point) for point in sample_path(d)]
+    expected = (min(p.x for p in points), min(p.y for p in points), max(p.x for p in points), max(p.y for p in points))
+    measured = (box["left"], box["top"], box["right"], box["bottom"])
+
+    # Sampled points are inside the curve, the engine box may only be larger by the sampling error
+    errors = (expected[0] - measured[0], expected[1] - measured[1], measured[2] - expected[2], measured[3] - expected[3])
+    if all(-1e-9 <= error <= TOLERANCE * max(1.0, abs(value)) for (error, value) in zip(errors, expected)):
+        return None
+    return "{} ({}): engine {} sampled {}".format(d, transform, measured, expected)
+
+
+def check_cubic_extremes():
+    """The turning points of a few curves with known extremes"""
+    curves = numpy.array(CURVES, dtype=float)
+    extremes = BoundingBoxEngine.cubic_extremes(curves)
+    failures = []
+    for (curve, points) in zip(curves, extremes):
+        sampled = numpy.array([bezier([tuple(point) for point in curve], step / SAMPLES) for step in range(SAMPLES + 1)])
+        if not (numpy.allclose(points.min(axis=0), sampled.min(axis=0), atol=TOLERANCE)
+                and numpy.allclose(points.max(axis=0), sampled.max(axis=0), atol=TOLERANCE)):
+            failures.append("cubic_extremes of {}: {} sampled {}".format(curve.tolist(), points.tolist(), sampled.tolist()[::SAMPLES // 4]))
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Correctness check for the path geometry of BoundingBoxEngine")
+    parser.add_argument("--paths", type=int, default=500, help="number of random paths")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the random paths")
+    args = parser.parse_args()
+
+    if numpy is None:
+        print("numpy isn't installed, the engine measures everything with inkex")
+        return 0
+
+    generator = random.Random(args.seed)
+    cases = FIXED_PATHS + [(random_path(generator), random_transform(generator)) for i in range(args.paths)]
+    failures = check_cubic_extremes()
+    failures += [failure for failure in (check_path(d, transform) for (d, transform) in cases) if failure]
+
+    for failure in failures:
+        print("FAIL: " + failure)
+    print("{} paths and {} curves checked, {} failures".format(len(cases), len(CURVES), len(failures)))
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,17 +1,146 @@
 #! /usr/bin/env python
 
 import sys
+
+# A run for the export server is handed to it before the imports below, see svg_stencil_export_client.py
+if __name__ == "__main__":
+    import svg_stencil_export_client
+    svg_stencil_export_client.hand_off(sys.argv[1:])
+
+import re
 import inkex
 from lxml import etree
 import os
 import subprocess
 import tempfile
-import shutil
 import copy
+import shutil
 import logging
 import json
 import glob
-import shutil
+import threading
+import queue
+import concurrent.futures
+import hashlib
+import math
+import time
+import tracemalloc
+import contextlib
+import base64
+import mimetypes
+import urllib.parse
+import html
+import gzip
+import signal
+import socket
+import io
+import traceback
+
+from svg_stencil_export_client import export_server_socket_path, export_server_version, export_server_connect, send_message, receive_message
+
+# Optional, .br files are only written when it's installed
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Optional, the bounding boxes are measured by inkex without it
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Elements the extension can export itself, see SVGStencilExporter.is_native_layer
+NATIVE_SHAPE_TAGS = {inkex.addNS(tag, 'svg') for tag in ('path', 'rect', 'circle', 'ellipse', 'line', 'polyline', 'polygon')}
+NATIVE_TAGS = NATIVE_SHAPE_TAGS | {inkex.addNS(tag, 'svg') for tag in ('g', 'title', 'desc')}
+NATIVE_BLOCKING_PROPERTIES = ('filter', 'marker', 'marker-start', 'marker-mid', 'marker-end', 'clip-path', 'mask')
+
+# url(#id) references to defs, in attributes, style properties and <style> elements
+DEFS_URL_REFERENCE = re.compile(r'url\(\s*[\'"]?#([^)\'"\s]+)')
+
+GROUP_TAG = inkex.addNS('g', 'svg')
+LABEL_ATTRIBUTE = inkex.addNS('label', 'inkscape')
+INSENSITIVE_ATTRIBUTE = inkex.addNS('insensitive', 'sodipodi')
+# Every layer of a document, nested ones included, in document order
+LAYERS_XPATH = etree.XPath('//svg:g[@inkscape:groupmode="layer"]', namespaces=inkex.NSS)
+
+# Permissions of the written files follow the umask, as with open()
+FILE_UMASK = os.umask(0)
+os.umask(FILE_UMASK)
+
+# Embedded images written to the assets folder, see SVGStencilExporter.extract_embedded_images
+IMAGE_TAG = inkex.addNS('image', 'svg')
+IMAGE_HREFS = (inkex.addNS('href', 'xlink'), 'href')
+ASSETS_FOLDER = "assets"
+SPRITE_FILE = "stencil-sprite.svg"
+JOURNAL_FILE = ".stencil-export-journal.jsonl"
+
+# Deadline of an inkscape export, see SVGStencilExporter.export_timeout
+EXPORT_TIMEOUT_MINIMUM = 30
+EXPORT_BYTES_PER_SECOND = 20000
+EXPORT_SECONDS_PER_HEAVY_ELEMENT = 5
+HEAVY_ELEMENT = re.compile(rb'<(?:svg:)?(?:filter|text|flowRoot|image|use)\b')
+THUMBNAILS_FOLDER = "thumbnails"
+# Metadata files that get compressed sidecars next to the components, see writePrecompressed
+PRECOMPRESSED_FILES = ("stencil-components.json", "stencil-meta.json", "index.html", SPRITE_FILE)
+PRECOMPRESSED_EXTENSIONS = ('.gz', '.br')
+# Hash of every precompressed file at the time its .gz and .br were written
+PRECOMPRESSED_MANIFEST = ".stencil-precompressed.json"
+# Bookkeeping files of the exporter, they aren't reported as written files
+EXPORT_CACHE_FILE = ".stencil-export-cache.json"
+INTERNAL_FILES = (EXPORT_CACHE_FILE, PRECOMPRESSED_MANIFEST, JOURNAL_FILE)
+
+# Used by ComponentMinifier
+PATH_TAG = inkex.addNS('path', 'svg')
+DEFS_TAG = inkex.addNS('defs', 'svg')
+STYLE_TAG = inkex.addNS('style', 'svg')
+METADATA_TAG = inkex.addNS('metadata', 'svg')
+TEXT_CONTENT_TAGS = {inkex.addNS(tag, 'svg') for tag in ('text', 'tspan', 'textPath', 'title', 'desc', 'style', 'script', 'flowRoot', 'flowPara', 'flowSpan')}
+DEFINITION_TAGS = {inkex.addNS(tag, 'svg') for tag in ('defs', 'symbol', 'pattern', 'marker', 'clipPath', 'mask')}
+NUMBER = re.compile(r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?')
+CSS_ID_SELECTOR = re.compile(r'#([A-Za-z_][\w.-]*)')
+NUMERIC_ATTRIBUTES = {'x', 'y', 'dx', 'dy', 'width', 'height', 'cx', 'cy', 'r', 'rx', 'ry', 'fx', 'fy', 'x1', 'y1', 'x2', 'y2', 'points', 'viewBox', 'stroke-width', 'font-size'}
+NUMERIC_STYLE_PROPERTIES = {'stroke-width', 'stroke-dasharray', 'stroke-dashoffset', 'stroke-miterlimit', 'font-size', 'line-height', 'letter-spacing', 'word-spacing', 'opacity', 'fill-opacity', 'stroke-opacity', 'stop-opacity'}
+INHERITED_PROPERTIES = {'fill', 'fill-opacity', 'fill-rule', 'stroke', 'stroke-width', 'stroke-opacity', 'stroke-dasharray', 'stroke-dashoffset',
+                        'stroke-linecap', 'stroke-linejoin', 'stroke-miterlimit', 'marker', 'marker-start', 'marker-mid', 'marker-end',
+                        'clip-rule', 'visibility', 'paint-order', 'font-style', 'font-variant', 'font-weight', 'font-stretch',
+                        'text-anchor', 'direction', 'letter-spacing', 'word-spacing', 'color-interpolation', 'color-interpolation-filters',
+                        'shape-rendering', 'image-rendering', 'text-rendering', 'font-variation-settings', 'font-feature-settings'}
+DEFAULT_STYLE = {
+        'opacity': {'1'}, 'display': {'inline'}, 'mix-blend-mode': {'normal'}, 'isolation': {'auto'}, 'filter': {'none'},
+        'clip-path': {'none'}, 'mask': {'none'}, 'stop-opacity': {'1'}, 'enable-background': {'accumulate'}, 'vector-effect': {'none'},
+        'fill': {'#000000', '#000', 'black'}, 'fill-opacity': {'1'}, 'fill-rule': {'nonzero'}, 'stroke': {'none'}, 'stroke-width': {'1', '1px'},
+        'stroke-opacity': {'1'}, 'stroke-dasharray': {'none'}, 'stroke-dashoffset': {'0'}, 'stroke-linecap': {'butt'}, 'stroke-linejoin': {'miter'},
+        'stroke-miterlimit': {'4'}, 'marker': {'none'}, 'marker-start': {'none'}, 'marker-mid': {'none'}, 'marker-end': {'none'},
+        'clip-rule': {'nonzero'}, 'visibility': {'visible'}, 'paint-order': {'normal', 'fill stroke markers', 'fill stroke'},
+        'font-style': {'normal'}, 'font-variant': {'normal'}, 'font-weight': {'normal', '400'}, 'font-stretch': {'normal'},
+        'text-anchor': {'start'}, 'direction': {'ltr'}, 'letter-spacing': {'normal'}, 'word-spacing': {'normal'},
+        'color-interpolation': {'srgb'}, 'color-interpolation-filters': {'linearrgb'}, 'shape-rendering': {'auto'},
+        'image-rendering': {'auto'}, 'text-rendering': {'auto'}, 'font-variation-settings': {'normal'}, 'font-feature-settings': {'normal'},
+        }
+
+# Previews per page of the cover page
+COVER_PAGE_SIZE = 60
+THUMBNAIL_NAME = re.compile(r'^[0-9a-f]{16}\.png$')
+SYMBOL_ID_INVALID = re.compile(r'[^A-Za-z0-9_.-]')
+DATA_URI = re.compile(r'data:([^;,]*)((?:;[^;,]*)*),', re.IGNORECASE)
+PATH_TOKEN = re.compile(r'[MmLlHhVvCcSsQqTtAaZz]|[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?')
+RECT_TAG = inkex.addNS('rect', 'svg')
+CIRCLE_TAG = inkex.addNS('circle', 'svg')
+ELLIPSE_TAG = inkex.addNS('ellipse', 'svg')
+LINE_TAG = inkex.addNS('line', 'svg')
+# The attributes that make up the geometry of the shapes BoundingBoxEngine measures itself
+GEOMETRY_ATTRIBUTES = {
+        PATH_TAG: ('d',),
+        RECT_TAG: ('x', 'y', 'width', 'height', 'rx', 'ry'),
+        CIRCLE_TAG: ('cx', 'cy', 'r'),
+        ELLIPSE_TAG: ('cx', 'cy', 'rx', 'ry'),
+        LINE_TAG: ('x1', 'y1', 'x2', 'y2'),
+        inkex.addNS('polyline', 'svg'): ('points',),
+        inkex.addNS('polygon', 'svg'): ('points',),
+        }
+PATH_ARGUMENTS = {'M': 2, 'L': 2, 'H': 1, 'V': 1, 'C': 6, 'S': 4, 'Q': 4, 'T': 2, 'A': 7, 'Z': 0}
+IMAGE_EXTENSIONS = {'image/png': 'png', 'image/jpeg': 'jpg', 'image/jpg': 'jpg', 'image/gif': 'gif', 'image/webp': 'webp', 'image/svg+xml': 'svg', 'image/bmp': 'bmp'}
 
 class Options():
     def __init__(self, svg_stencil_exporter):
@@ -29,12 +158,30 @@ class Options():
         self.write_meta = self._str_to_bool(svg_stencil_exporter.options.write_meta)
         self.write_components = self._str_to_bool(svg_stencil_exporter.options.write_components)
         self.create_cover_page = self._str_to_bool(svg_stencil_exporter.options.create_cover_page)
+        self.cover_page_mode = svg_stencil_exporter.options.cover_page_mode
+        # The sprite cover page needs the sprite
+        self.write_sprite = self._str_to_bool(svg_stencil_exporter.options.write_sprite) or (self.create_cover_page and self.cover_page_mode == "sprite")
         self.create_readme = self._str_to_bool(svg_stencil_exporter.options.create_readme)
         self.update_parent_index = self._str_to_bool(svg_stencil_exporter.options.update_parent_index)
         self.copy_parent_meta_stencils_json = self._str_to_bool(svg_stencil_exporter.options.copy_parent_meta_stencils_json)
 
         self.output_path = os.path.normpath(svg_stencil_exporter.options.path)
         self.overwrite_files = self._str_to_bool(svg_stencil_exporter.options.overwrite_files)
+        self.use_inkscape_shell = self._str_to_bool(svg_stencil_exporter.options.use_inkscape_shell)
+        self.workers = max(1, svg_stencil_exporter.options.workers)
+        self.use_export_cache = self._str_to_bool(svg_stencil_exporter.options.use_export_cache)
+        self.use_export_journal = self._str_to_bool(svg_stencil_exporter.options.use_export_journal)
+        self.native_export = self._str_to_bool(svg_stencil_exporter.options.native_export)
+        self.write_profile = self._str_to_bool(svg_stencil_exporter.options.write_profile)
+        self.write_thumbnails = self._str_to_bool(svg_stencil_exporter.options.write_thumbnails)
+        self.thumbnail_size = max(16, svg_stencil_exporter.options.thumbnail_size)
+        self.precompress = self._str_to_bool(svg_stencil_exporter.options.precompress)
+        self.minify = self._str_to_bool(svg_stencil_exporter.options.minify)
+        self.deduplicate = self._str_to_bool(svg_stencil_exporter.options.deduplicate)
+        self.minify_precision = max(0, svg_stencil_exporter.options.minify_precision)
+        self.shared_assets = self._str_to_bool(svg_stencil_exporter.options.shared_assets)
+        self.export_timeout = max(1.0, svg_stencil_exporter.options.export_timeout)
+        self.export_retries = max(0, svg_stencil_exporter.options.export_retries)
 
         self.use_logging = self._str_to_bool(svg_stencil_exporter.options.use_logging)
         if self.use_logging:
@@ -52,19 +199,812 @@ class Options():
         toprint += "Current file:     {}\n".format(self.current_file)
         toprint += "Path:             {}\n".format(self.output_path)
         toprint += "Overwrite files:  {}\n".format(self.overwrite_files)
+        toprint += "Inkscape shell:   {}\n".format(self.use_inkscape_shell)
+        toprint += "Workers:          {}\n".format(self.workers)
+        toprint += "Export timeout:   {}\n".format(self.export_timeout)
+        toprint += "Export retries:   {}\n".format(self.export_retries)
+        toprint += "Export cache:     {}\n".format(self.use_export_cache)
+        toprint += "Export journal:   {}\n".format(self.use_export_journal)
+        toprint += "Native export:    {}\n".format(self.native_export)
+        toprint += "Write profile:    {}\n".format(self.write_profile)
+        toprint += "Write sprite:     {}\n".format(self.write_sprite)
+        toprint += "Thumbnails:       {}\n".format(self.write_thumbnails)
+        toprint += "Thumbnail size:   {}\n".format(self.thumbnail_size)
+        toprint += "Precompress:      {}\n".format(self.precompress)
+        toprint += "Minify:           {}\n".format(self.minify)
+        toprint += "Deduplicate:      {}\n".format(self.deduplicate)
+        toprint += "Minify precision: {}\n".format(self.minify_precision)
+        toprint += "Cover page mode:  {}\n".format(self.cover_page_mode)
+        toprint += "Shared assets:    {}\n".format(self.shared_assets)
         toprint += "Use logging:      {}\n".format(self.use_logging)
         toprint += "---------------------------------------\n"
         return toprint
 
-    def _str_to_bool(self, str):
+    @staticmethod
+    def _str_to_bool(str):
+        if isinstance(str, bool):
+            return str
         if str.lower() == 'true':
             return True
         return False
 
+# Run a command in its own process group, a timeout kills everything it started.
+# Raises subprocess.TimeoutExpired like subprocess.run.
+def run_process(command, timeout, input=None, stdout=subprocess.PIPE, stderr=None, cwd=None):
+    proc = subprocess.Popen(command, stdin=subprocess.PIPE if input is not None else subprocess.DEVNULL,
+                            stdout=stdout, stderr=stderr, cwd=cwd, start_new_session=(os.name == 'posix'))
+    try:
+        output, _ = proc.communicate(input, timeout=timeout)
+    except BaseException:
+        kill_process_tree(proc)
+        proc.communicate()
+        raise
+    return subprocess.CompletedProcess(command, proc.returncode, output)
+
+# Inkscape may start helper processes (e.g. the AppImage wrapper), they go with it
+def kill_process_tree(proc):
+    try:
+        if os.name == 'posix':
+            os.killpg(proc.pid, signal.SIGKILL)
+        else:
+            proc.kill()
+    except OSError:
+        pass
+    proc.wait()
+
+class InkscapeShell():
+    """Keep one inkscape process in --shell mode and send it one action line per layer.
+
+    Starting inkscape takes far longer than exporting a single layer, so on stencils with
+    hundreds of layers this is a lot faster than one process per layer. Inkscape prints a
+    "> " prompt after every processed line, which is used to know when a layer is done.
+    """
+
+    def __init__(self, use_logging, timeout=300):
+        self.use_logging = use_logging
+        self.timeout = timeout
+        self.proc = None
+        self.prompts = 0
+        self.closed = False
+        self.condition = threading.Condition()
+        # Private folder for the files the shell opens and writes, see export
+        self.folder = None
+
+    def start(self):
+        # As in export_to_file, inkscape warnings only end up in the log when logging is on.
+        stderr = None if self.use_logging else subprocess.DEVNULL
+        self.prompts = 0
+        self.closed = False
+        self.proc = subprocess.Popen(['inkscape', '--shell'], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                     stderr=stderr, universal_newlines=True, bufsize=1,
+                                     start_new_session=(os.name == 'posix'))
+        self.folder = tempfile.mkdtemp(prefix='svg-stencil-shell-')
+        self.reader = threading.Thread(target=self._read_prompts, daemon=True)
+        self.reader.start()
+
+        # Wait for the first prompt, inkscape is ready after that
+        return self._wait_for_prompt(1)
+
+    def _read_prompts(self):
+        last_chars = "\n"
+        while True:
+            char = self.proc.stdout.read(1)
+            if not char:
+                break
+            last_chars = (last_chars + char)[-3:]
+            if last_chars.endswith("\n> "):
+                with self.condition:
+                    self.prompts += 1
+                    self.condition.notify_all()
+
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def _wait_for_prompt(self, count, timeout=None):
+        with self.condition:
+            self.condition.wait_for(lambda: self.prompts >= count or self.closed, timeout=timeout or self.timeout)
+            return self.prompts >= count
+
+    # Returns the status, "exported", "failed" or "timeout" when inkscape didn't answer within
+    # timeout seconds, and the exported file
+    def export(self, content, timeout=None, layer_folder=None):
+        # The shell can only open files. The layer is written to the folder of the shell, or to
+        # layer_folder when relative links like the shared assets have to resolve from there.
+        # Inkscape writes to the folder of the shell, nothing is left next to the components.
+        with tempfile.NamedTemporaryFile(delete=False, dir=layer_folder or self.folder, prefix='.layer-', suffix='.svg') as svg_file:
+            svg_file.write(content)
+        try:
+            return self._export_output(svg_file.name, '.svg', ['vacuum-defs', 'export-plain-svg', 'export-type:svg', 'export-area-drawing'], timeout)
+        finally:
+            # A shell that didn't answer is killed together with its folder
+            if os.path.exists(svg_file.name):
+                os.remove(svg_file.name)
+
+    # A png of an svg file on disk, size is ('width', pixels) or ('height', pixels)
+    # Returns the png, or None when the export failed
+    def export_png(self, svg_path, size):
+        (status, output) = self._export_output(svg_path, '.png', ['export-type:png', 'export-area-page', 'export-{}:{}'.format(*size)])
+        return output
+
+    def _export_output(self, svg_path, suffix, export_actions, timeout=None):
+        export_path = os.path.join(self.folder, 'export' + suffix)
+        try:
+            status = self._export_file(svg_path, export_path, export_actions, timeout)
+            if status != "exported":
+                return (status, None)
+            with open(export_path, 'rb') as export_file:
+                return (status, export_file.read())
+        finally:
+            if os.path.exists(export_path):
+                os.remove(export_path)
+
+    def _export_file(self, svg_path, output_path, export_actions, timeout=None):
+        # Actions are separated by ';', a path containing one can't be sent as an action line
+        if ';' in svg_path or ';' in output_path:
+            return "failed"
+
+        actions = ['file-open:{}'.format(svg_path)]
+        actions.extend(export_actions)
+        actions.extend([
+                'export-filename:{}'.format(output_path),
+                'export-do',
+                'file-close',
+                ])
+        line = ';'.join(actions)
+        logging.debug("    shell: {}\n".format(line))
+
+        expected_prompts = self.prompts + 1
+        try:
+            self.proc.stdin.write(line + "\n")
+            self.proc.stdin.flush()
+        except OSError:
+            return "failed"
+
+        if not self._wait_for_prompt(expected_prompts, timeout):
+            logging.debug("    shell: no answer from inkscape for {}".format(svg_path))
+            # The prompts can't be matched to layers anymore, the next export starts a fresh process
+            closed = self.closed
+            self.kill()
+            return "failed" if closed else "timeout"
+
+        if os.path.exists(output_path) and os.path.getsize(output_path) > 0:
+            return "exported"
+        return "failed"
+
+    def close(self):
+        if self.proc is None:
+            return
+        try:
+            self.proc.stdin.write("quit\n")
+            self.proc.stdin.close()
+            self.proc.wait(timeout=self.timeout)
+        except (OSError, subprocess.TimeoutExpired):
+            self.kill()
+            return
+        self._release()
+
+    def kill(self):
+        kill_process_tree(self.proc)
+        self._release()
+
+    def _release(self):
+        self.reader.join()
+        for stream in (self.proc.stdin, self.proc.stdout):
+            try:
+                stream.close()
+            except OSError:
+                pass
+        self.proc = None
+        shutil.rmtree(self.folder, ignore_errors=True)
+        self.folder = None
+
+class Profiler():
+    """Record wall time and peak memory of the export stages, per layer where it applies.
+
+    The result is written to stencil-export-profile.json in the output folder, so runs can be
+    compared between releases. Memory is traced with tracemalloc, which slows down the export,
+    so nothing is recorded unless profiling is enabled. With more than one worker, stages run
+    at the same time and the peak memory of a stage includes the work of the other workers.
+    """
+
+    def __init__(self, enabled, workers=1):
+        self.enabled = enabled
+        self.workers = workers
+        self.stages = []
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+
+        if self.enabled and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextlib.contextmanager
+    def stage(self, name, layer_id=None):
+        if not self.enabled:
+            yield
+            return
+
+        # The peak can only be reset when no other stage is running
+        if self.workers == 1 and hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        start_memory = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            peak_memory = tracemalloc.get_traced_memory()[1]
+            with self.lock:
+                self.stages.append({
+                        "stage": name,
+                        "layer_id": layer_id,
+                        "seconds": round(seconds, 6),
+                        "peak_memory": max(0, peak_memory - start_memory),
+                        })
+
+    def write(self, output_path):
+        if not self.enabled:
+            return
+
+        summary = {}
+        layers = {}
+        for stage in self.stages:
+            total = summary.setdefault(stage["stage"], {"count": 0, "seconds": 0.0, "max_seconds": 0.0, "peak_memory": 0})
+            total["count"] += 1
+            total["seconds"] = round(total["seconds"] + stage["seconds"], 6)
+            total["max_seconds"] = max(total["max_seconds"], stage["seconds"])
+            total["peak_memory"] = max(total["peak_memory"], stage["peak_memory"])
+
+            if stage["layer_id"] is not None:
+                layers[stage["layer_id"]] = round(layers.get(stage["layer_id"], 0.0) + stage["seconds"], 6)
+
+        slowest_layers = sorted(layers.items(), key=lambda layer: layer[1], reverse=True)[:20]
+
+        profile = {
+                "generator": "SVG Stencil Export - Inkscape Extension - Version 1.4",
+                "workers": self.workers,
+                "total_seconds": round(time.perf_counter() - self.started, 6),
+                "peak_memory": tracemalloc.get_traced_memory()[1],
+                "summary": summary,
+                "slowest_layers": [{"layer_id": layer_id, "seconds": seconds} for (layer_id, seconds) in slowest_layers],
+                "stages": self.stages,
+                }
+
+        with open(os.path.join(output_path, "stencil-export-profile.json"), 'w') as json_file:
+            json.dump(profile, json_file, indent=1)
+
+class LayerRecord():
+    """A layer of the document as found by LayerIndex."""
+
+    __slots__ = ('id', 'label', 'type', 'parents', 'transform', 'translate_x', 'translate_y',
+                 'hidden', 'element', 'sub_layer_paths')
+
+    def __init__(self, element, parents, transform):
+        self.element = element
+        self.id = element.attrib.get('id')
+        self.label = element.attrib.get(LABEL_ATTRIBUTE)
+        # Ids of the layers around this one, the closest first
+        self.parents = parents
+
+        # The own transform of the layer, any form inkscape writes (translate(x), matrix, ...).
+        # Read from attrib, inkex rewrites the attribute when it's read through get().
+        # Most layers have none, they share the transform of their parent.
+        own_transform = element.attrib.get('transform')
+        if own_transform:
+            own_transform = inkex.Transform(own_transform)
+            self.translate_x = own_transform.e
+            self.translate_y = own_transform.f
+            # Everything from the root down to and including the layer
+            self.transform = transform @ own_transform
+        else:
+            self.translate_x = 0.0
+            self.translate_y = 0.0
+            self.transform = transform
+
+        self.hidden = 'display:none' in element.attrib.get('style', '')
+        self.type = "locked" if 'true' in element.attrib.get(INSENSITIVE_ATTRIBUTE, '') else "component"
+
+        # Child index paths from this layer to its direct sub layers, see SVGStencilExporter.clean_up_target_file
+        self.sub_layer_paths = []
+
+class LayerIndex():
+    """All layers of a document, found in one pass over the tree.
+
+    Every stage of the export works with this index instead of searching the document again.
+    lxml finds the groups, only the groups between a layer and the layer or root around it
+    are looked at in Python. A layer can't be inside any other element than a group.
+    """
+
+    def __init__(self, root):
+        # Every layer in document order, including hidden and unlabelled ones
+        self.layers = []
+        self.by_id = {}
+        # Records by element, a layer comes after the layers around it in document order
+        records = {}
+        for element in LAYERS_XPATH(root):
+            # Up to the closest layer or the root: the child index path and the transforms
+            # of the groups in between, the innermost first
+            path = []
+            transforms = []
+            child = element
+            parent = element.getparent()
+            while parent is not root and parent not in records:
+                if parent is None or parent.tag != GROUP_TAG:
+                    break
+                path.append(parent.index(child))
+                own_transform = parent.attrib.get('transform')
+                if own_transform:
+                    transforms.append(own_transform)
+                child = parent
+                parent = parent.getparent()
+            else:
+                layer = records.get(parent)
+                transform = layer.transform if layer is not None else inkex.Transform()
+                for own_transform in reversed(transforms):
+                    transform = transform @ inkex.Transform(own_transform)
+
+                record = LayerRecord(element, [layer.id] + layer.parents if layer is not None else [], transform)
+                records[element] = record
+                self.layers.append(record)
+                if record.id is not None:
+                    self.by_id[record.id] = record
+                if layer is not None:
+                    path.append(parent.index(child))
+                    layer.sub_layer_paths.append(path[::-1])
+
+    # The layers that aren't inside another layer
+    def outer_layers(self):
+        return [layer for layer in self.layers if not layer.parents]
+
+class BoundingBoxEngine():
+    """Geometric bounding boxes of layers, measured with NumPy.
+
+    Paths and basic shapes are turned into points, cubic curves and ellipses. The composed
+    transforms of the layer, its groups and the shapes are applied to all of them in one go,
+    the extremes of the curves are solved for in one go and the result is reduced to a box
+    per element. Elements the engine can't measure, like text, images, clones and arcs, are
+    measured by inkex with the same composed transform, and so is everything when NumPy
+    isn't installed.
+
+    The boxes are kept per element geometry and transform for the whole process, so the
+    elements that come back in other layers, like the start rects of locked layers, and in
+    the next exports of WatchExport aren't measured again. Layers are measured in parallel,
+    the cache is only read with get and filled under cache_lock.
+    """
+
+    cache = {}
+    cache_lock = threading.Lock()
+    CACHE_SIZE = 200000
+    # Cached boxes can be None for shapes without an area
+    UNMEASURED = object()
+
+    def layer_bbox(self, layer, transform):
+        """The box of everything in the layer as {left, top, right, bottom}, None when it's empty.
+
+        transform is the composed transform of the layer, including its own.
+        """
+        boxes = []
+        pending = []
+        self._walk(layer, transform, boxes, pending)
+        if pending:
+            boxes += self._measure(pending)
+
+        boxes = [box for box in boxes if box is not None]
+        if not boxes:
+            return None
+        return {
+                "left":   min(box[0] for box in boxes),
+                "top":    min(box[1] for box in boxes),
+                "right":  max(box[2] for box in boxes),
+                "bottom": max(box[3] for box in boxes),
+                }
+
+    def _walk(self, element, transform, boxes, pending):
+        for child in element:
+            # Comments and processing instructions don't end up in the drawing
+            if not isinstance(child.tag, str):
+                continue
+
+            own_transform = child.attrib.get('transform')
+            child_transform = transform @ inkex.Transform(own_transform) if own_transform else transform
+
+            if child.tag == GROUP_TAG:
+                self._walk(child, child_transform, boxes, pending)
+                continue
+
+            geometry_attributes = GEOMETRY_ATTRIBUTES.get(child.tag) if numpy is not None else None
+            geometry = None
+            if geometry_attributes is not None:
+                matrix = child_transform.matrix
+                content = "\0".join(child.attrib.get(name, '') for name in geometry_attributes)
+                key = (child.tag, matrix[0], matrix[1], hashlib.blake2b(content.encode(), digest_size=16).digest())
+                cached = self.cache.get(key, self.UNMEASURED)
+                if cached is not self.UNMEASURED:
+                    boxes.append(cached)
+                    continue
+                try:
+                    geometry = self.shape_geometry(child)
+                except ValueError:
+                    geometry = None
+
+            if geometry is not None:
+                pending.append((key, geometry, child_transform))
+            elif hasattr(child, 'bounding_box'):
+                # inkex applies the own transform of the element itself
+                box = child.bounding_box(transform)
+                if box:
+                    boxes.append((box.left, box.top, box.right, box.bottom))
+
+    def _measure(self, pending):
+        """Boxes of the elements, all of them in one pass per kind of geometry"""
+        count = len(pending)
+        # a, b, c, d, e, f of every element
+        matrices = numpy.array([(t.a, t.b, t.c, t.d, t.e, t.f) for (key, geometry, t) in pending])
+        lows = numpy.full((count, 2), numpy.inf)
+        highs = numpy.full((count, 2), -numpy.inf)
+
+        for (kind, size) in ((0, 2), (1, 8), (2, 4)):
+            values = [geometry[kind] for (key, geometry, t) in pending]
+            counts = numpy.array([len(value) // size for value in values])
+            if not counts.sum():
+                continue
+            owners = numpy.repeat(numpy.arange(count), counts)
+            shapes = numpy.fromiter((number for value in values for number in value), float).reshape(-1, size)
+            m = matrices[owners]
+
+            if kind == 2:
+                # Ellipses as cx, cy, rx, ry
+                centers = self.apply(m, shapes[:, 0:2])
+                half_x = numpy.hypot(m[:, 0] * shapes[:, 2], m[:, 2] * shapes[:, 3])
+                half_y = numpy.hypot(m[:, 1] * shapes[:, 2], m[:, 3] * shapes[:, 3])
+                half = numpy.stack((half_x, half_y), axis=1)
+                low, high = centers - half, centers + half
+            else:
+                points = self.apply(m[:, None, :], shapes.reshape(len(shapes), -1, 2))
+                if kind == 1:
+                    points = self.cubic_extremes(points)
+                low, high = points.min(axis=1), points.max(axis=1)
+
+            numpy.minimum.at(lows, owners, low)
+            numpy.maximum.at(highs, owners, high)
+
+        boxes = []
+        for (index, (key, geometry, t)) in enumerate(pending):
+            box = None
+            if lows[index, 0] <= highs[index, 0]:
+                box = (float(lows[index, 0]), float(lows[index, 1]), float(highs[index, 0]), float(highs[index, 1]))
+            boxes.append(box)
+
+        with self.cache_lock:
+            if len(self.cache) + count > self.CACHE_SIZE:
+                self.cache.clear()
+            for ((key, geometry, t), box) in zip(pending, boxes):
+                self.cache[key] = box
+        return boxes
+
+    @staticmethod
+    def apply(m, points):
+        """Applies the matrices (a, b, c, d, e, f) in m to points with x, y in the last axis"""
+        x = points[..., 0]
+        y = points[..., 1]
+        return numpy.stack((m[..., 0] * x + m[..., 2] * y + m[..., 4],
+                            m[..., 1] * x + m[..., 3] * y + m[..., 5]), axis=-1)
+
+    @staticmethod
+    def cubic_extremes(curves):
+        """The end points of the curves and the points where they turn, shape (n, 6, 2)"""
+        p0, p1, p2, p3 = curves[:, 0], curves[:, 1], curves[:, 2], curves[:, 3]
+        # The derivative divided by 3 is a t² + b t + c, per axis
+        a = p3 - p0 + 3 * (p1 - p2)
+        b = 2 * (p0 - 2 * p1 + p2)
+        c = p1 - p0
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            root = numpy.sqrt(b * b - 4 * a * c)
+            linear = numpy.abs(a) < 1e-12
+            t1 = numpy.where(linear, -c / b, (-b + root) / (2 * a))
+            t2 = numpy.where(linear, numpy.nan, (-b - root) / (2 * a))
+        t = numpy.concatenate((t1, t2), axis=1)
+        # Roots outside the curve (and nan) are replaced by its start
+        t = numpy.where((t > 0) & (t < 1), t, 0.0)[:, :, None]
+        s = 1 - t
+        turns = (s ** 3 * p0[:, None] + 3 * s * s * t * p1[:, None] + 3 * s * t * t * p2[:, None] + t ** 3 * p3[:, None])
+        return numpy.concatenate((turns, p0[:, None], p3[:, None]), axis=1)
+
+    @classmethod
+    def shape_geometry(cls, element):
+        """(points, cubic curves, ellipses) of a shape as flat lists, None when inkex has to measure it"""
+        tag = element.tag
+        get = element.attrib.get
+        if tag == PATH_TAG:
+            return cls.path_geometry(get('d', ''))
+        if tag == RECT_TAG:
+            if get('rx') or get('ry'):
+                return None
+            (x, y, width, height) = (cls.length(get(name)) for name in ('x', 'y', 'width', 'height'))
+            return ([x, y, x + width, y, x, y + height, x + width, y + height], [], [])
+        if tag == CIRCLE_TAG:
+            r = cls.length(get('r'))
+            return ([], [], [cls.length(get('cx')), cls.length(get('cy')), r, r])
+        if tag == ELLIPSE_TAG:
+            return ([], [], [cls.length(get(name)) for name in ('cx', 'cy', 'rx', 'ry')])
+        if tag == LINE_TAG:
+            return ([cls.length(get(name)) for name in ('x1', 'y1', 'x2', 'y2')], [], [])
+        # polyline and polygon
+        points = [float(number) for number in NUMBER.findall(get('points', ''))]
+        return (points[:len(points) // 2 * 2], [], [])
+
+    @staticmethod
+    def length(value):
+        """A user unit value of an attribute, anything else is left to inkex"""
+        if value is None:
+            return 0.0
+        parsed = inkex.units.parse_unit(value)
+        if parsed is None or parsed[1] != 'px':
+            raise ValueError("Unsupported length: {}".format(value))
+        return parsed[0]
+
+    @staticmethod
+    def path_geometry(d):
+        """Points and cubic curves of path data, None when it has arcs"""
+        points = []
+        curves = []
+        tokens = PATH_TOKEN.findall(d)
+        x = y = start_x = start_y = 0.0
+        # The last control points, for the smooth curve commands
+        cubic_control = quadratic_control = None
+        command = None
+        index = 0
+        while index < len(tokens):
+            if tokens[index].isalpha():
+                command = tokens[index]
+                index += 1
+                if command in 'Zz':
+                    x, y = start_x, start_y
+                    cubic_control = quadratic_control = None
+                    continue
+            elif command is None or command in 'Zz':
+                raise ValueError("Number without a command in path data")
+
+            upper = command.upper()
+            if upper == 'A':
+                return None
+            size = PATH_ARGUMENTS[upper]
+            if index + size > len(tokens):
+                raise ValueError("Incomplete path data")
+            args = [float(value) for value in tokens[index:index + size]]
+            index += size
+
+            # Relative coordinates start at the current point
+            dx, dy = (x, y) if command.islower() else (0.0, 0.0)
+            if upper == 'H':
+                args = [args[0] + dx, y]
+            elif upper == 'V':
+                args = [x, args[0] + dy]
+            else:
+                args = [value + (dx if i % 2 == 0 else dy) for (i, value) in enumerate(args)]
+
+            if upper == 'M':
+                start_x, start_y = args
+                points += args
+                # More coordinates after a moveto are linetos
+                command = 'l' if command == 'm' else 'L'
+            elif upper in 'LHV':
+                points += args
+            elif upper in 'CS':
+                if upper == 'S':
+                    first = (2 * x - cubic_control[0], 2 * y - cubic_control[1]) if cubic_control else (x, y)
+                    args = list(first) + args
+                curves += [x, y] + args
+                cubic_control = (args[2], args[3])
+            else:
+                if upper == 'T':
+                    control = (2 * x - quadratic_control[0], 2 * y - quadratic_control[1]) if quadratic_control else (x, y)
+                    args = list(control) + args
+                # The same curve as a cubic one
+                (qx, qy, end_x, end_y) = args
+                curves += [x, y, x + 2 * (qx - x) / 3, y + 2 * (qy - y) / 3,
+                           end_x + 2 * (qx - end_x) / 3, end_y + 2 * (qy - end_y) / 3, end_x, end_y]
+                quadratic_control = (qx, qy)
+
+            if upper not in 'CS':
+                cubic_control = None
+            if upper not in 'QT':
+                quadratic_control = None
+            x, y = args[-2], args[-1]
+        return (points, curves, [])
+
+class ComponentMinifier():
+    """Make an exported component smaller without changing how it looks.
+
+    Numbers are rounded to a number of decimals and path data is written without needless
+    separators and repeated commands. Editor data, comments, whitespace between elements,
+    ids nobody refers to, default style values and groups without attributes are removed.
+    """
+
+    def __init__(self, precision):
+        self.precision = precision
+
+    def minify(self, content):
+        root = etree.fromstring(content, parser=etree.XMLParser(huge_tree=True))
+
+        self.remove_editor_data(root)
+        self.remove_unreferenced_ids(root)
+
+        # Default values of inherited properties can only go when nothing else may set them:
+        # no style sheet, and no <use> that passes its own style to what it shows
+        keep_inherited = root.find('.//svg:style', namespaces=inkex.NSS) is not None or root.find('.//svg:use', namespaces=inkex.NSS) is not None
+        self.clean_element(root, set(), keep_inherited)
+
+        self.collapse_groups(root)
+        self.remove_whitespace(root)
+        etree.cleanup_namespaces(root)
+        return etree.tostring(root, xml_declaration=True, encoding='UTF-8')
+
+    def remove_element(self, element):
+        # The tail is text of the parent, inside a <text> it's part of the drawing
+        if element.tail:
+            previous = element.getprevious()
+            if previous is not None:
+                previous.tail = (previous.tail or '') + element.tail
+            else:
+                parent = element.getparent()
+                parent.text = (parent.text or '') + element.tail
+        element.getparent().remove(element)
+
+    def remove_editor_data(self, root):
+        editor_namespaces = ('{%s}' % inkex.NSS['inkscape'], '{%s}' % inkex.NSS['sodipodi'])
+        for element in list(root.iter()):
+            if not isinstance(element.tag, str):
+                if isinstance(element, etree._Comment):
+                    self.remove_element(element)
+                continue
+            if element.tag.startswith(editor_namespaces) or element.tag == METADATA_TAG:
+                self.remove_element(element)
+                continue
+            for name in list(element.attrib):
+                if name.startswith(editor_namespaces):
+                    del element.attrib[name]
+
+    def remove_unreferenced_ids(self, root):
+        references = set()
+        for element in root.iter():
+            if not isinstance(element.tag, str):
+                continue
+            if element.tag == STYLE_TAG and element.text:
+                references.update(CSS_ID_SELECTOR.findall(element.text))
+            for (name, value) in element.attrib.items():
+                if 'url(' in value:
+                    references.update(DEFS_URL_REFERENCE.findall(value))
+                elif (name == 'href' or name.endswith('}href')) and value.startswith('#'):
+                    references.add(value[1:])
+
+        for element in root.iter():
+            if isinstance(element.tag, str) and element.get('id') is not None and element.get('id') not in references:
+                del element.attrib['id']
+
+    def clean_element(self, element, inherited, keep_inherited):
+        if element.tag in DEFINITION_TAGS:
+            # Shown where they're used, with the inherited style of that place
+            keep_inherited = True
+
+        if 'style' in element.attrib:
+            style = inkex.Style(element.attrib['style'])
+            for (name, value) in list(style.items()):
+                if name.startswith('-inkscape-'):
+                    del style[name]
+                    continue
+                if name in NUMERIC_STYLE_PROPERTIES:
+                    value = self.numbers(value)
+                    style[name] = value
+                # An inherited default can only go when no parent sets another value
+                if name in DEFAULT_STYLE and value.strip().lower() in DEFAULT_STYLE[name]:
+                    if name not in INHERITED_PROPERTIES or not (keep_inherited or name in inherited):
+                        del style[name]
+
+            if style:
+                element.attrib['style'] = str(style)
+            else:
+                del element.attrib['style']
+
+        for name in NUMERIC_ATTRIBUTES.intersection(element.attrib):
+            element.attrib[name] = self.numbers(element.attrib[name])
+        if 'transform' in element.attrib:
+            # Scale and rotation factors need more decimals, they multiply the coordinates
+            element.attrib['transform'] = self.numbers(element.attrib['transform'], self.precision + 3)
+        if element.tag == PATH_TAG and element.get('d'):
+            element.attrib['d'] = self.path_data(element.attrib['d'])
+
+        # The properties the children inherit from this element
+        specified = set(inherited)
+        specified.update(INHERITED_PROPERTIES.intersection(element.attrib))
+        specified.update(INHERITED_PROPERTIES.intersection(inkex.Style(element.get('style', '')).keys()))
+        for child in element:
+            if isinstance(child.tag, str):
+                self.clean_element(child, specified, keep_inherited)
+
+    # Groups without attributes don't change their children, they're replaced by them
+    def collapse_groups(self, root):
+        for group in reversed(list(root.iter(GROUP_TAG))):
+            if group.attrib:
+                continue
+            if len(group) == 0:
+                self.remove_element(group)
+                continue
+
+            parent = group.getparent()
+            index = parent.index(group)
+            for child in reversed(list(group)):
+                parent.insert(index, child)
+            self.remove_element(group)
+
+        for defs in root.iter(DEFS_TAG):
+            if len(defs) == 0 and not defs.attrib:
+                self.remove_element(defs)
+
+    # Whitespace between elements, but not in text, where it's part of the drawing
+    def remove_whitespace(self, root):
+        for element in root.iter():
+            if not isinstance(element.tag, str) or element.tag in TEXT_CONTENT_TAGS:
+                continue
+            if element.text is not None and not element.text.strip():
+                element.text = None
+            for child in element:
+                if child.tail is not None and not child.tail.strip():
+                    child.tail = None
+
+    def number(self, value, precision=None):
+        if precision is None:
+            precision = self.precision
+
+        text = "{:.{}f}".format(value, precision)
+        if '.' in text:
+            text = text.rstrip('0').rstrip('.')
+        if text in ('-0', ''):
+            return '0'
+        if text.startswith('0.'):
+            return text[1:]
+        if text.startswith('-0.'):
+            return '-' + text[2:]
+        return text
+
+    def numbers(self, value, precision=None):
+        return NUMBER.sub(lambda match: self.number(float(match.group(0)), precision), value)
+
+    # Absolute coordinates, so rounding doesn't add up along the path
+    def path_data(self, d):
+        tokens = []
+        previous_letter = None
+        for segment in inkex.Path(d).to_absolute():
+            # A repeated command can be left out, after a move it would mean a line
+            if segment.letter != previous_letter or segment.letter == 'M':
+                tokens.append(segment.letter)
+            tokens.extend(self.number(value) for value in segment.args)
+            previous_letter = segment.letter
+
+        data = ''
+        previous = None
+        for token in tokens:
+            # Numbers only need a separator when the next one doesn't start with a sign or a
+            # second decimal point
+            if previous is not None and not token.isalpha() and not previous.isalpha():
+                if not (token.startswith('-') or (token.startswith('.') and '.' in previous)):
+                    data += ' '
+            data += token
+            previous = token
+
+        return data if len(data) < len(d) else d
+
 class SVGStencilExporter(inkex.Effect):
     def __init__(self):
         """init the effetc library and get options from gui"""
         inkex.Effect.__init__(self)
+        self.profiler = Profiler(False)
+        self.sprite_symbols = {}
+        self.skipped_layers = []
+        # Generated files that were written by this run, see write_if_changed
+        self.touched_files = []
+        # Set when the export runs in an ExportServer
+        self.export_server = None
 
         # Controls page
         self.arg_parser.add_argument("--stencil-name", action="store", type=str, dest="stencil_name", default="no-name", help="")
@@ -76,18 +1016,47 @@ class SVGStencilExporter(inkex.Effect):
         # Controls page
         self.arg_parser.add_argument("--path", action="store", type=str, dest="path", default="", help="export path")
         self.arg_parser.add_argument("--overwrite-files", action="store", type=str, dest="overwrite_files", default=False, help="")
+        self.arg_parser.add_argument("--use-inkscape-shell", action="store", type=str, dest="use_inkscape_shell", default=False, help="export all layers through one inkscape --shell process")
+        self.arg_parser.add_argument("--workers", action="store", type=int, dest="workers", default=1, help="number of layers prepared and exported in parallel")
+        self.arg_parser.add_argument("--export-timeout", action="store", type=float, dest="export_timeout", default=300, help="longest time in seconds an inkscape export of a layer may take")
+        self.arg_parser.add_argument("--export-retries", action="store", type=int, dest="export_retries", default=1, help="number of times a failed layer export is tried again")
+        self.arg_parser.add_argument("--use-export-cache", action="store", type=str, dest="use_export_cache", default=False, help="only export layers that changed since the last export")
+        self.arg_parser.add_argument("--use-export-journal", action="store", type=str, dest="use_export_journal", default=False, help="record every exported layer, so an interrupted export can be resumed")
+        self.arg_parser.add_argument("--native-export", action="store", type=str, dest="native_export", default=False, help="write simple layers without running inkscape")
+        self.arg_parser.add_argument("--shared-assets", action="store", type=str, dest="shared_assets", default=False, help="write embedded images once to the assets folder and refer to them from the components")
+        self.arg_parser.add_argument("--deduplicate", action="store", type=str, dest="deduplicate", default=False, help="export layers with the same drawing once and map the others to that file")
+        self.arg_parser.add_argument("--minify", action="store", type=str, dest="minify", default=False, help="make the exported components smaller, see ComponentMinifier")
+        self.arg_parser.add_argument("--minify-precision", action="store", type=int, dest="minify_precision", default=3, help="decimals kept by --minify")
         self.arg_parser.add_argument("--use-logging", action="store", type=str, dest="use_logging", default=False, help="")
+        self.arg_parser.add_argument("--write-profile", action="store", type=str, dest="write_profile", default=False, help="write timings and memory use to stencil-export-profile.json")
 
         self.arg_parser.add_argument("--write-meta", action="store", type=str, dest="write_meta", default=False, help="")
         self.arg_parser.add_argument("--write-components", action="store", type=str, dest="write_components", default=False, help="")
+        self.arg_parser.add_argument("--write-thumbnails", action="store", type=str, dest="write_thumbnails", default=False, help="write a png thumbnail of every component for the cover page")
+        self.arg_parser.add_argument("--thumbnail-size", action="store", type=int, dest="thumbnail_size", default=200, help="longest side of the thumbnails in pixels")
+        self.arg_parser.add_argument("--write-sprite", action="store", type=str, dest="write_sprite", default=False, help="write all components as symbols to stencil-sprite.svg")
         self.arg_parser.add_argument("--create-github-action", action="store", type=str, dest="create_github_action", default=False, help="")
         self.arg_parser.add_argument("--create-gitlab-action", action="store", type=str, dest="create_gitlab_action", default=False, help="")
         self.arg_parser.add_argument("--create-cover-page", action="store", type=str, dest="create_cover_page", default=False, help="")
+        self.arg_parser.add_argument("--cover-page-mode", action="store", type=str, dest="cover_page_mode", default="images", help="images: one image per component, sprite: render from stencil-sprite.svg")
         self.arg_parser.add_argument("--create-readme", action="store", type=str, dest="create_readme", default=False, help="")
+        self.arg_parser.add_argument("--precompress", action="store", type=str, dest="precompress", default=False, help="write .gz (and .br with the brotli module) files next to the published files")
         self.arg_parser.add_argument("--update-parent-index", action="store", type=str, dest="update_parent_index", default=False, help="")
         self.arg_parser.add_argument("--copy-parent-meta-stencils-json", action="store", type=str, dest="copy_parent_meta_stencils_json", default=False, help="")
 
 
+        # Headless export of many documents, see BatchExport
+        self.arg_parser.add_argument("--batch", action="append", type=str, dest="batch", default=[], help="directory or glob of stencil documents to export, each to its own folder in --path")
+
+        # Export again on every save of the document, see WatchExport
+        self.arg_parser.add_argument("--watch", action="store", type=str, dest="watch", default=False, help="keep running and export the document again when it changes")
+        self.arg_parser.add_argument("--watch-interval", action="store", type=float, dest="watch_interval", default=1.0, help="seconds between checks of the document in --watch mode")
+
+        # Hand the export to a long lived process, see ExportServer and svg_stencil_export_client.py
+        self.arg_parser.add_argument("--use-export-server", action="store", type=str, dest="use_export_server", default=False, help="run the export in a background process that stays up between runs")
+        self.arg_parser.add_argument("--export-server", action="store", type=str, dest="export_server", default=False, help="run as the export server (started by --use-export-server)")
+        self.arg_parser.add_argument("--server-idle-timeout", action="store", type=float, dest="server_idle_timeout", default=600, help="seconds the export server waits for a job before it stops")
+
         # HACK - the script is called with a "--tab controls" option as an argument from the notebook param in the inx file.
         # This argument is not used in the script. It's purpose is to suppress an error when the script is called.
         self.arg_parser.add_argument("--tab", action="store", type=str, dest="tab", default="controls", help="")
@@ -102,70 +1071,628 @@ class SVGStencilExporter(inkex.Effect):
             os.makedirs(os.path.join(options.output_path))
 
         logging.debug(options)
+        self.profiler = Profiler(options.write_profile, options.workers)
 
-        components_list = []
-        components_data = {}
+        # Prepare and export the layers in parallel, each worker uses its own inkscape process
+        # The inkscape shells of the export server stay up for its next job
+        if self.export_server is not None:
+            shells = self.export_server.shell_pool(options)
+        else:
+            shells = self.create_shell_pool(options)
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=options.workers) as pool:
+                results = self.export_layers(options, pool, shells)
+        finally:
+            if self.export_server is None:
+                self.close_shell_pool(shells)
+
+        self.write_outputs(options, results)
+        with self.profiler.stage("writeParentHTML"):
+            self.writeParentHTML(options)
+        self.log_touched_files()
 
+        self.profiler.write(options.output_path)
+
+        logging.debug("===============================\n\nSTENCIL EXPORT FINSISHED:\n")
+
+    # Export all layers of the document with the given pool and shells, which may be
+    # shared with other documents (see BatchExport)
+    def export_layers(self, options, pool, shells):
         # Build the partial inkscape export command
         command = self.build_partial_command(options)
 
         # Get the layers from the current file
-        layers = self.get_layers()
+        with self.profiler.stage("get_layers"):
+            layers = self.get_layers()
+
+        # Before the skeleton and the layer copies are made, so they don't copy the image data
+        with self.profiler.stage("extract_embedded_images"):
+            self.extract_embedded_images(options)
+        try:
+            with self.profiler.stage("build_skeleton"):
+                self.skeleton = self.build_skeleton()
+
+            # Hashes of the layers exported by the previous run
+            manifest = self.read_manifest(options)
+            # Layers finished by an interrupted run count as exported, see journal_layer
+            journal = self.read_journal(options)
+            if journal:
+                logging.debug("  Resuming, {} layers finished by the last run".format(len(journal)))
+                manifest.update(journal)
+            export_options = self.export_options_key(options, command)
+
+            futures = []
+            counter = 0
+            for layer in layers:
+                counter += 1
+                futures.append(pool.submit(self.prepare_layer, options, manifest, export_options, counter, layer))
+
+            # Gather the results in counter order, so the output doesn't depend on the scheduling.
+            # A layer that can't be prepared is reported, the other layers are exported.
+            results = []
+            for (counter, (layer, future)) in enumerate(zip(layers, futures), 1):
+                try:
+                    results.append(future.result())
+                except Exception as error:
+                    results.append(self.failed_layer(options, counter, layer, error))
+        finally:
+            # The layer files are serialized now, the document gets its images back
+            self.restore_embedded_images()
+        prepared = [result for result in results if result and result["action"] != "failed"]
+        # Layers without anything in them, for the summary in write_outputs
+        self.skipped_layers = [layer.label for (layer, result) in zip(layers, results) if not result]
+        if options.deduplicate:
+            self.mark_duplicates(prepared)
+
+        journal = open(os.path.join(options.output_path, JOURNAL_FILE), 'a') if options.use_export_journal else contextlib.nullcontext()
+        with journal as journal_file:
+            # Renames go first, a new export may take the old name of a renamed file
+            self.rename_cached_files(options, prepared)
+            for result in prepared:
+                if result["action"] == "rename":
+                    self.journal_layer(journal_file, result)
+
+            # The biggest layers start first, a slow layer that starts last holds up the whole export.
+            # Every layer goes to the journal, when there is one, as soon as it's done.
+            scheduled = sorted(prepared, key=lambda result: len(result["content"] or b""), reverse=True)
+            futures = {pool.submit(self.export_layer, options, command, shells, result): result for result in scheduled}
+            for future in concurrent.futures.as_completed(futures):
+                result = futures[future]
+                try:
+                    future.result()
+                except Exception as error:
+                    logging.debug("  Export of {} failed: {!r}".format(result["file_name"], error))
+                    result["exported"] = False
+                    result["failure"] = "error"
+                    result["error"] = str(error) or type(error).__name__
+                    continue
+                if result["action"] in ("export", "native") and result["exported"] and result["cacheable"]:
+                    self.journal_layer(journal_file, result)
+
+        for result in prepared:
+            if result["duplicate_of"]:
+                result["exported"] = result["duplicate_of"]["exported"]
+
+        self.export_thumbnails(options, pool, shells, prepared)
 
-        counter = 0
-        # For each layer export a file
-        for (layer_id, layer_label, layer_type, parents, translate_x, translate_y) in layers:
-            counter += 1
-            show_layer_ids = [layer[0] for layer in layers or layer[0] == layer_id]
+        self.write_manifest(options, results)
+        return results
 
-            # Construct the name of the exported file
-            file_name = "{}_{}.{}".format(counter, layer_label, "svg")
-            logging.debug("  File name: {}".format(file_name))
+    # Everything written after the components, except the parent index
+    def write_outputs(self, options, results):
+        components_list = []
+        components_data = {}
 
+        failed = []
+        for result in results:
+            if not result:
+                continue
+
+            if not result["exported"]:
+                failed.append(self.failure_description(result))
+                continue
 
-            # Create a new file in which we delete unwanted layers to keep the exported file size to a minimum
-            logging.debug("  Preparing layer target file [{}]".format(layer_label))
-            temporary_file = self.clean_up_target_file(layer_id, show_layer_ids)
-            if not temporary_file:
+            # Duplicates aren't components of their own, they point to the shared file
+            if result["duplicate_of"]:
+                components_data[result["file_name"]] = dict(result["data"], file=result["duplicate_of"]["file_name"])
                 continue
 
             # Add to components for json
-            components_list.append(file_name)
+            components_list.append(result["file_name"])
             # Add to extra componentData for json
-            components_data[file_name] = {
-                    "type": layer_type,
-                    "top": (temporary_file['top'] + self.makeFloat(translate_y)),
-                    "bottom": (temporary_file['bottom'] + self.makeFloat(translate_y)),
-                    "left": (temporary_file['left'] + self.makeFloat(translate_x)),
-                    "right": (temporary_file['right'] + self.makeFloat(translate_x)),
-                    "translate_x": self.makeFloat(translate_x),
-                    "translate_y": self.makeFloat(translate_y),
-                    }
+            components_data[result["file_name"]] = result["data"]
 
-            # Check if the file exists. If not, export it.
-            destination_path = os.path.join(options.output_path, file_name)
-            if not options.overwrite_files and os.path.exists(destination_path):
-                logging.debug("  File already exists: {}\n".format(file_name))
+        # Summary of the layers that aren't in the stencil
+        if self.skipped_layers:
+            logging.debug("  Skipped empty layers: {}".format(self.skipped_layers))
+        if failed:
+            logging.debug("  Failed exports: {}".format(failed))
+            inkex.errormsg('Error while exporting {}.'.format(', '.join(failed)))
 
+        self.delete_temp_elements()
+        with self.profiler.stage("writeSprite"):
+            self.writeSprite(options, components_list, components_data)
+        with self.profiler.stage("writeComponentsJson"):
+            self.writeComponentsJson(options, components_list, components_data)
+        with self.profiler.stage("writeMetaJson"):
+            self.writeMetaJson(options)
+        with self.profiler.stage("writeGitHubAction"):
+            self.writeGitHubAction(options)
+        with self.profiler.stage("writeGitlabAction"):
+            self.writeGitlabAction(options)
+        with self.profiler.stage("writeMarkdown"):
+            self.writeMarkdown(options)
+        with self.profiler.stage("writeHTML"):
+            self.writeHTML(options, components_list, components_data)
+        with self.profiler.stage("copyParentMetaJSON"):
+            self.copyParentMetaJSON(options)
+        with self.profiler.stage("writePrecompressed"):
+            self.writePrecompressed(options, components_list)
+
+        # Everything is written, the next run has nothing to resume
+        journal_path = os.path.join(options.output_path, JOURNAL_FILE)
+        if os.path.exists(journal_path):
+            os.remove(journal_path)
+
+    def failure_description(self, result):
+        if result["duplicate_of"]:
+            reason = "same drawing as {}".format(result["duplicate_of"]["file_name"])
+        elif result["failure"] == "error":
+            reason = result["error"]
+        elif result["failure"] == "timeout":
+            reason = "no result from Inkscape in {} attempts".format(result["attempts"])
+        else:
+            reason = "Inkscape failed {} times".format(result["attempts"])
+        return "{} ({})".format(result["file_name"], reason)
+
+    # The result of a layer that couldn't be prepared, for the failure summary
+    def failed_layer(self, options, counter, layer, error):
+        logging.debug("  Preparing [{}] failed: {!r}".format(layer.label, error))
+        file_name = "{}_{}.{}".format(counter, layer.label, "svg")
+        return {
+                "layer_id": layer.id,
+                "layer_label": layer.label,
+                "file_name": file_name,
+                "destination": os.path.join(options.output_path, file_name),
+                "hash": None,
+                "action": "failed",
+                "rename_from": None,
+                "content": None,
+                "exported": False,
+                "cacheable": False,
+                "duplicate_of": None,
+                "attempts": 0,
+                "failure": "error",
+                "error": str(error) or type(error).__name__,
+                "data": {},
+                }
+
+    # Prepare a single layer and decide if it needs an export, runs in a worker thread
+    def prepare_layer(self, options, manifest, export_options, counter, layer):
+        layer_id = layer.id
+        layer_label = layer.label
+
+        # Construct the name of the exported file
+        file_name = "{}_{}.{}".format(counter, layer_label, "svg")
+        logging.debug("  File name: {}".format(file_name))
+
+        # Create a new file in which we delete unwanted layers to keep the exported file size to a minimum
+        logging.debug("  Preparing layer target file [{}]".format(layer_label))
+        with self.profiler.stage("clean_up_target_file", layer_id):
+            target_file = self.clean_up_target_file(layer_id)
+        if not target_file:
+            return None
+
+        result = {
+                "layer_id": layer_id,
+                "layer_label": layer_label,
+                "file_name": file_name,
+                "destination": os.path.join(options.output_path, file_name),
+                "hash": hashlib.sha256(export_options.encode() + target_file["content"]).hexdigest(),
+                "action": "export",
+                "rename_from": None,
+                "content": None,
+                "exported": True,
+                "cacheable": True,
+                "duplicate_of": None,
+                "attempts": 0,
+                "failure": None,
+                "data": {
+                    "type": layer.type,
+                    "top": target_file['top'],
+                    "bottom": target_file['bottom'],
+                    "left": target_file['left'],
+                    "right": target_file['right'],
+                    "translate_x": self.makeFloat(layer.translate_x),
+                    "translate_y": self.makeFloat(layer.translate_y),
+                    }
+                }
+
+        if options.deduplicate:
+            result["shape_hash"] = self.shape_hash(export_options, target_file)
+
+        # Check if the file exists. If not, export it.
+        cached = manifest.get(layer_id)
+        if not options.overwrite_files and os.path.exists(result["destination"]):
+            logging.debug("  File already exists: {}\n".format(file_name))
+            result["action"] = "skip"
+            # The existing file may come from an older version of the layer
+            result["cacheable"] = bool(cached) and cached["hash"] == result["hash"]
+            if result["cacheable"] and "bytes_saved" in cached:
+                result["data"]["bytes_saved"] = cached["bytes_saved"]
+
+        elif cached and cached["hash"] == result["hash"] and os.path.exists(os.path.join(options.output_path, cached["file_name"])):
+            if "bytes_saved" in cached:
+                result["data"]["bytes_saved"] = cached["bytes_saved"]
+            if cached["file_name"] == file_name:
+                logging.debug("  Unchanged since the last export: {}\n".format(file_name))
+                result["action"] = "skip"
             else:
-                logging.debug("  Exporting [{}] as {}".format(layer_label, file_name))
-                self.export_to_file(command.copy(), temporary_file["name"], destination_path, options.use_logging)
+                logging.debug("  Unchanged but renumbered: {} -> {}\n".format(cached["file_name"], file_name))
+                result["action"] = "rename"
+                result["rename_from"] = cached["file_name"]
+
+        elif options.native_export and self.is_native_layer(target_file["layer"]):
+            # Simple layers are cropped and written here, without a round trip through inkscape
+            with self.profiler.stage("native_component", layer_id):
+                result["native_content"] = self.native_component(target_file["document"], target_file["layer"])
+            result["action"] = "native" if result["native_content"] else "export"
+
+        if result["action"] == "export":
+            # Kept in memory and piped to inkscape, no temporary file
+            result["content"] = target_file["content"]
+
+        return result
+
+    # Hash of the layer file without what tells copies of a layer apart: the id and label of the
+    # layer and the ids nobody refers to. The attributes are put back after hashing.
+    def shape_hash(self, export_options, target_file):
+        references = self.find_references(target_file["document"].getroot())
+
+        removed = []
+        for element in target_file["layer"].iter():
+            if isinstance(element.tag, str) and 'id' in element.attrib and element.attrib['id'] not in references:
+                removed.append((element, 'id', element.attrib.pop('id')))
+        label_name = inkex.addNS('label', 'inkscape')
+        if label_name in target_file["layer"].attrib:
+            removed.append((target_file["layer"], label_name, target_file["layer"].attrib.pop(label_name)))
 
-                # Clean up - delete the temporary file we have created
-                os.remove(temporary_file["name"])
+        try:
+            return hashlib.sha256(export_options.encode() + etree.tostring(target_file["document"])).hexdigest()
+        finally:
+            for (element, name, value) in removed:
+                element.attrib[name] = value
+
+    # Only the first layer of the ones with the same drawing is exported, in counter order
+    def mark_duplicates(self, prepared):
+        shared = {}
+        for result in prepared:
+            first = shared.setdefault(result["shape_hash"], result)
+            if first is result:
+                continue
 
-        self.delete_temp_elements()
-        self.writeComponentsJson(options, components_list, components_data)
-        self.writeMetaJson(options)
-        self.writeGitHubAction(options)
-        self.writeGitlabAction(options)
-        self.writeMarkdown(options)
-        self.writeHTML(options, components_list)
-        self.writeParentHTML(options)
-        self.copyParentMetaJSON(options)
+            logging.debug("  Same drawing as {}: {}".format(first["file_name"], result["file_name"]))
+            result["action"] = "duplicate"
+            result["duplicate_of"] = first
+            result["cacheable"] = False
+            result["content"] = None
+            result["native_content"] = None
+
+    # Export a prepared layer, runs in a worker thread
+    def export_layer(self, options, command, shells, result):
+        if result["action"] == "native":
+            logging.debug("  Writing [{}] as {}".format(result["layer_label"], result["file_name"]))
+            content = result["native_content"]
+            if options.minify:
+                content = self.minify_component(options, result, content)
+            self.write_atomic(result["destination"], content)
+            return
 
-        logging.debug("===============================\n\nSTENCIL EXPORT FINSISHED:\n")
+        if result["action"] != "export":
+            return
+
+        logging.debug("  Exporting [{}] as {}".format(result["layer_label"], result["file_name"]))
+        with self.profiler.stage("export_to_file", result["layer_id"]):
+            # Every attempt gets twice the time of the one before, a layer that keeps failing is
+            # given up on instead of holding up the rest of the stencil
+            timeout = self.export_timeout(options, result["content"])
+            result["exported"] = False
+            while not result["exported"] and result["attempts"] <= options.export_retries:
+                result["attempts"] += 1
+                status = self.export_with_pool(options, command, shells, result["content"], result["destination"], timeout)
+                result["exported"] = status == "exported"
+                if not result["exported"]:
+                    logging.debug("  Export of {} {} in attempt {} ({:.0f} s)".format(result["file_name"], status, result["attempts"], timeout))
+                    result["failure"] = status
+                    timeout = min(timeout * 2, options.export_timeout)
+        result["content"] = None
+
+        if result["exported"] and options.minify:
+            with open(result["destination"], 'rb') as component_file:
+                content = component_file.read()
+            minified = self.minify_component(options, result, content)
+            if minified is not content:
+                self.write_atomic(result["destination"], minified)
+
+    # Deadline of one export attempt: time to get going, more for bigger layers and for every
+    # filter, text, image and clone in them, never more than --export-timeout
+    def export_timeout(self, options, content):
+        heavy_elements = len(HEAVY_ELEMENT.findall(content))
+        timeout = EXPORT_TIMEOUT_MINIMUM + len(content) / EXPORT_BYTES_PER_SECOND + heavy_elements * EXPORT_SECONDS_PER_HEAVY_ELEMENT
+        return min(timeout, options.export_timeout)
+
+    # Returns the smaller component, or the content itself when it can't be made smaller
+    def minify_component(self, options, result, content):
+        with self.profiler.stage("minify", result["layer_id"]):
+            try:
+                minified = ComponentMinifier(options.minify_precision).minify(content)
+            except etree.XMLSyntaxError:
+                logging.debug("  Can't minify {}".format(result["file_name"]))
+                minified = content
+
+        if len(minified) >= len(content):
+            minified = content
+        result["data"]["bytes_saved"] = len(content) - len(minified)
+        logging.debug("  Minified {}: {} bytes saved".format(result["file_name"], result["data"]["bytes_saved"]))
+        return minified
+
+    # Move unchanged components to their new number. Goes through temporary names,
+    # because a file may get the old name of another file that is renamed as well.
+    def rename_cached_files(self, options, prepared):
+        renames = [result for result in prepared if result["action"] == "rename"]
+        # A file another layer keeps, e.g. a layer skipped onto an existing file with
+        # --overwrite-files=false, is copied instead of moved
+        kept = {result["destination"] for result in prepared if result["action"] != "rename"}
+
+        # The compressed copies move with their component, a copy of the file that had the
+        # name before is removed
+        for result in renames:
+            source = os.path.join(options.output_path, result["rename_from"])
+            for extension in ("",) + PRECOMPRESSED_EXTENSIONS:
+                if not os.path.exists(source + extension):
+                    continue
+                if source in kept:
+                    logging.debug("  Copying {}, another layer keeps it".format(result["rename_from"] + extension))
+                    with open(source + extension, 'rb') as source_file:
+                        self.write_atomic(result["destination"] + extension + ".renaming", source_file.read())
+                else:
+                    os.replace(source + extension, result["destination"] + extension + ".renaming")
+
+        for result in renames:
+            for extension in ("",) + PRECOMPRESSED_EXTENSIONS:
+                destination = result["destination"] + extension
+                if os.path.exists(destination + ".renaming"):
+                    os.replace(destination + ".renaming", destination)
+                elif extension and os.path.exists(destination):
+                    os.remove(destination)
+
+    def export_options_key(self, options, command):
+        return json.dumps({
+                "command": command,
+                "native_export": options.native_export,
+                "minify": options.minify_precision if options.minify else None,
+                })
+
+    # Small previews of the components for the cover page, through the same inkscape processes
+    # as the export. Thumbnails are named by the hash of their component, so an unchanged
+    # component keeps its thumbnail and thumbnails of old components can be removed.
+    def export_thumbnails(self, options, pool, shells, results):
+        if not options.write_thumbnails:
+            return
+
+        thumbnails_path = os.path.join(options.output_path, THUMBNAILS_FOLDER)
+        os.makedirs(thumbnails_path, exist_ok=True)
+
+        futures = [pool.submit(self.export_thumbnail, options, shells, result) for result in results if result["exported"] and not result["duplicate_of"]]
+        for future in futures:
+            future.result()
+
+        used = {os.path.basename(result["data"]["thumbnail"]) for result in results if "thumbnail" in result["data"]}
+        for file_name in os.listdir(thumbnails_path):
+            if THUMBNAIL_NAME.match(file_name) and file_name not in used:
+                os.remove(os.path.join(thumbnails_path, file_name))
+
+    # Runs in a worker thread
+    def export_thumbnail(self, options, shells, result):
+        try:
+            with open(result["destination"], 'rb') as component_file:
+                component = component_file.read()
+        except OSError:
+            return
+
+        file_name = "{}.png".format(hashlib.sha256(component + str(options.thumbnail_size).encode()).hexdigest()[:16])
+        thumbnail_path = os.path.join(options.output_path, THUMBNAILS_FOLDER, file_name)
+
+        if not os.path.exists(thumbnail_path):
+            logging.debug("  Thumbnail of {}: {}".format(result["file_name"], file_name))
+            with self.profiler.stage("export_thumbnail", result["layer_id"]):
+                size = self.thumbnail_export_size(options, component)
+                if not self.export_png_with_pool(options, shells, result["destination"], thumbnail_path, size):
+                    logging.debug("  No thumbnail for {}".format(result["file_name"]))
+                    return
+
+        result["data"]["thumbnail"] = "{}/{}".format(THUMBNAILS_FOLDER, file_name)
+
+    # The longest side of the component gets the thumbnail size
+    def thumbnail_export_size(self, options, component):
+        try:
+            root = etree.fromstring(component, parser=etree.XMLParser(huge_tree=True))
+        except etree.XMLSyntaxError:
+            return ('width', options.thumbnail_size)
+
+        view_box = (root.get('viewBox') or '').replace(',', ' ').split()
+        if len(view_box) == 4 and self.makeFloat(view_box[3]) > self.makeFloat(view_box[2]):
+            return ('height', options.thumbnail_size)
+        return ('width', options.thumbnail_size)
+
+    # Write to a temporary file next to the destination and move it in place,
+    # readers never see a half written file
+    def write_atomic(self, destination_path, content):
+        with tempfile.NamedTemporaryFile(delete=False, dir=os.path.dirname(destination_path), suffix='.tmp') as temporary_file:
+            temporary_file.write(content)
+        # Temporary files are only readable by the owner, the components are published
+        os.chmod(temporary_file.name, 0o666 & ~FILE_UMASK)
+        os.replace(temporary_file.name, destination_path)
+
+    # Generated files are only replaced when their content changed. Unchanged files keep their
+    # mtime, so rsync, ETags, git and Pages deployments don't see a change that isn't one.
+    # Returns True when the file was written.
+    def write_if_changed(self, destination_path, content):
+        if os.path.exists(destination_path) and os.path.getsize(destination_path) == len(content):
+            with open(destination_path, 'rb') as current_file:
+                if current_file.read() == content:
+                    return False
+
+        self.write_atomic(destination_path, content)
+        self.touched_files.append(destination_path)
+        return True
+
+    def log_touched_files(self):
+        logging.debug("  Files written: {}".format(self.touched_files or "none, all generated files were up to date"))
+
+    # The written files a user publishes, for the summary of the command line modes
+    def published_files(self):
+        return [path for path in self.touched_files if os.path.basename(path) not in INTERNAL_FILES]
+
+    def read_manifest(self, options):
+        manifest_path = os.path.join(options.output_path, EXPORT_CACHE_FILE)
+        if not options.use_export_cache or not os.path.exists(manifest_path):
+            return {}
+
+        try:
+            with open(manifest_path) as json_file:
+                manifest = json.load(json_file)
+        except (OSError, ValueError):
+            logging.debug("  Ignoring unreadable export cache {}".format(manifest_path))
+            return {}
+
+        return manifest.get("layers", {})
 
+    def write_manifest(self, options, results):
+        if not options.use_export_cache:
+            return
+
+        layers = {}
+        for result in results:
+            if result and result["exported"] and result["cacheable"]:
+                layers[result["layer_id"]] = {
+                        "hash": result["hash"],
+                        "file_name": result["file_name"],
+                        }
+                if "bytes_saved" in result["data"]:
+                    layers[result["layer_id"]]["bytes_saved"] = result["data"]["bytes_saved"]
+
+        manifest_path = os.path.join(options.output_path, EXPORT_CACHE_FILE)
+        self.write_if_changed(manifest_path, json.dumps({"layers": layers}).encode())
+
+    # Layers finished by a run that didn't get to the end, by layer id, in the format of the
+    # export cache. The last line of a crashed run may be cut off, it's skipped.
+    def read_journal(self, options):
+        journal_path = os.path.join(options.output_path, JOURNAL_FILE)
+        if not options.use_export_journal or not os.path.exists(journal_path):
+            return {}
+
+        layers = {}
+        try:
+            with open(journal_path) as journal_file:
+                for line in journal_file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if isinstance(record, dict) and "layer_id" in record:
+                        layers[record["layer_id"]] = record
+        except OSError:
+            logging.debug("  Ignoring unreadable export journal {}".format(journal_path))
+            return {}
+
+        return layers
+
+    # Append a finished layer to the journal. It's on disk before the next layer is done, so a
+    # run that hangs, crashes or is killed can be resumed by the next one. The position is
+    # measured again on resume, only what the export cache keeps is written.
+    def journal_layer(self, journal_file, result):
+        if journal_file is None:
+            return
+
+        record = {
+                "layer_id": result["layer_id"],
+                "hash": result["hash"],
+                "file_name": result["file_name"],
+                }
+        if "bytes_saved" in result["data"]:
+            record["bytes_saved"] = result["data"]["bytes_saved"]
+
+        journal_file.write(json.dumps(record) + "\n")
+        journal_file.flush()
+        os.fsync(journal_file.fileno())
+
+    # Pack all components into one file of <symbol> elements, so a page can show the whole stencil
+    # with a single request. The symbol id of every component goes to components_data.
+    def writeSprite(self, options, components_list, components_data):
+        self.sprite_symbols = {}
+        if not options.write_sprite:
+            return
+
+        sprite = etree.Element(inkex.addNS('svg', 'svg'), nsmap={None: inkex.NSS['svg'], 'xlink': inkex.NSS['xlink']})
+        for file_name in components_list:
+            symbol_id = "component-" + SYMBOL_ID_INVALID.sub('-', os.path.splitext(file_name)[0])
+            symbol = self.sprite_symbol(os.path.join(options.output_path, file_name), symbol_id)
+            if symbol is None:
+                logging.debug("  Not in the sprite: {}".format(file_name))
+                continue
+
+            sprite.append(symbol)
+            components_data[file_name]["symbol"] = symbol_id
+            self.sprite_symbols[file_name] = (symbol_id, symbol.get('viewBox'))
+
+        etree.cleanup_namespaces(sprite)
+        self.write_if_changed(os.path.join(options.output_path, SPRITE_FILE), etree.tostring(sprite, xml_declaration=True, encoding='UTF-8'))
+
+    def sprite_symbol(self, component_path, symbol_id):
+        try:
+            component = etree.parse(component_path, parser=etree.XMLParser(huge_tree=True)).getroot()
+        except (OSError, etree.XMLSyntaxError):
+            return None
+
+        view_box = component.get('viewBox')
+        if not view_box:
+            width = inkex.units.parse_unit(component.get('width', ''))
+            height = inkex.units.parse_unit(component.get('height', ''))
+            if not width or not height:
+                return None
+            view_box = "0 0 {} {}".format(width[0], height[0])
+
+        # Ids have to be unique in the sprite, they get the symbol id as prefix
+        ids = {element.get('id') for element in component.iter() if isinstance(element.tag, str) and element.get('id')}
+        def prefix_reference(match):
+            if match.group(1) not in ids:
+                return match.group(0)
+            return match.group(0).replace('#' + match.group(1), '#{}-{}'.format(symbol_id, match.group(1)))
+
+        for element in component.iter():
+            if not isinstance(element.tag, str):
+                continue
+            # <style> elements
+            if element.text and 'url(' in element.text:
+                element.text = DEFS_URL_REFERENCE.sub(prefix_reference, element.text)
+            for (name, value) in element.attrib.items():
+                if name == 'id':
+                    element.set(name, "{}-{}".format(symbol_id, value))
+                elif 'url(' in value:
+                    element.set(name, DEFS_URL_REFERENCE.sub(prefix_reference, value))
+                elif (name == 'href' or name.endswith('}href')) and value[1:] in ids and value.startswith('#'):
+                    element.set(name, "#{}-{}".format(symbol_id, value[1:]))
+
+        symbol = etree.Element(inkex.addNS('symbol', 'svg'), id=symbol_id, viewBox=view_box)
+        if component.get('preserveAspectRatio'):
+            symbol.set('preserveAspectRatio', component.get('preserveAspectRatio'))
+        for child in component:
+            # Editor data isn't part of the drawing
+            if child.tag in (inkex.addNS('namedview', 'sodipodi'), inkex.addNS('metadata', 'svg')):
+                continue
+            symbol.append(copy.deepcopy(child))
+        return symbol
 
     def writeComponentsJson(self, options, components_list, components_data):
         if options.write_components:
@@ -175,8 +1702,7 @@ class SVGStencilExporter(inkex.Effect):
                     "components_data" : components_data
                     }
 
-            with open(destination_comp_json, 'w') as json_file:
-                json.dump(stencil_comp_dict, json_file)
+            self.write_if_changed(destination_comp_json, json.dumps(stencil_comp_dict).encode())
 
 
     def writeMetaJson(self, options):
@@ -191,71 +1717,203 @@ class SVGStencilExporter(inkex.Effect):
                     "license": options.stencil_license_url,
                     }
 
-            with open(destination_meta_json, 'w') as json_file:
-                json.dump(stencil_meta_dict, json_file)
+            self.write_if_changed(destination_meta_json, json.dumps(stencil_meta_dict).encode())
+
+
+
+    # Write every embedded image once to the assets folder and point its <image> elements to the
+    # file, so the layer copies, the files piped to inkscape and the components only carry a short
+    # link. Images are named by the hash of their data, the same image is written only once.
+    def extract_embedded_images(self, options):
+        self.embedded_images = []
+        if not options.shared_assets:
+            return
+
+        assets = {}
+        for image in self.document.getroot().iter(IMAGE_TAG):
+            for name in IMAGE_HREFS:
+                value = image.attrib.get(name)
+                if not value or not value.startswith('data:'):
+                    continue
+
+                if value not in assets:
+                    assets[value] = self.write_asset(options, value)
+                if assets[value] is None:
+                    continue
+
+                self.embedded_images.append((image, name, value))
+                image.attrib[name] = assets[value]
+
+        logging.debug("  Shared assets: {} images, {} files".format(len(self.embedded_images), len(set(assets.values()) - {None})))
+
+    # Returns the link to the asset file, relative to the components
+    def write_asset(self, options, data_uri):
+        match = DATA_URI.match(data_uri)
+        if match is None:
+            return None
+
+        media_type = match.group(1).strip().lower()
+        data = data_uri[match.end():]
+        try:
+            if ';base64' in match.group(2).lower():
+                content = base64.b64decode(data)
+            else:
+                content = urllib.parse.unquote_to_bytes(data)
+        except ValueError:
+            logging.debug("  Can't decode embedded image of type [{}]".format(media_type))
+            return None
+
+        extension = IMAGE_EXTENSIONS.get(media_type) or (mimetypes.guess_extension(media_type) or '.bin').lstrip('.')
+        file_name = "{}.{}".format(hashlib.sha256(content).hexdigest()[:16], extension)
 
+        # The name is the hash of the content, an existing file is the same image
+        asset_path = os.path.join(options.output_path, ASSETS_FOLDER, file_name)
+        if not os.path.exists(asset_path):
+            os.makedirs(os.path.dirname(asset_path), exist_ok=True)
+            self.write_atomic(asset_path, content)
 
+        return "{}/{}".format(ASSETS_FOLDER, file_name)
+
+    def restore_embedded_images(self):
+        for (image, name, value) in self.embedded_images:
+            image.attrib[name] = value
+        self.embedded_images = []
 
     def delete_temp_elements(self):
-        temp_elements = self.document.xpath('//svg:path[@inkscape:label="temp_for_stencil_export"]', namespaces=inkex.NSS)
-        logging.debug("  temp_elements: [{}]".format(temp_elements))
+        logging.debug("  temp_elements: [{}]".format(self.temp_elements))
 
-        for temp_element in temp_elements:
+        for temp_element in self.temp_elements:
             logging.debug("  delete temp element: [{}]".format(temp_element))
             temp_element.getparent().remove(temp_element)
+        self.temp_elements = []
+
+
+    # Copy the document once without any layers and without the content of the defs. Every
+    # layer file starts from this skeleton, so the document isn't deep copied as a whole for
+    # each layer. The defs a layer needs are added to its copy by add_layer_defs.
+    def build_skeleton(self):
+        root = self.document.getroot()
+
+        # Only the outer layers need to be taken out, the sub layers go with them
+        outer_layers = [layer.element for layer in self.layer_index.outer_layers()]
+
+        # Temporarily detach the layers, copy what remains and put the layers back in place
+        positions = []
+        for layer in outer_layers:
+            parent = layer.getparent()
+            positions.append((parent, parent.index(layer), layer))
+        for (parent, index, layer) in positions:
+            parent.remove(layer)
+
+        # The same for the content of the defs
+        self.defs_children = []
+        for defs in root.findall('svg:defs', namespaces=inkex.NSS):
+            children = list(defs)
+            self.defs_children.append(children)
+            for child in children:
+                defs.remove(child)
 
+        try:
+            skeleton = copy.deepcopy(self.document)
+        finally:
+            # In document order, so every index is valid again when its layer is inserted
+            for (parent, index, layer) in positions:
+                parent.insert(index, layer)
+
+            for (defs, children) in zip(root.findall('svg:defs', namespaces=inkex.NSS), self.defs_children):
+                for child in children:
+                    defs.append(child)
+
+        self.build_defs_index(skeleton)
+        return skeleton
+
+    # Map every entry of the defs to the defs it refers to, through url(#...) and href,
+    # so each layer file only gets the defs it needs
+    def build_defs_index(self, skeleton):
+        self.defs_entries = {}
+        self.defs_by_id = {}
+        self.defs_references = {}
+
+        for (defs_number, children) in enumerate(self.defs_children):
+            for (child_number, child) in enumerate(children):
+                key = (defs_number, child_number)
+                self.defs_entries[key] = child
+                self.defs_references[key] = self.find_references(child)
+                for element in child.iter():
+                    if isinstance(element.tag, str) and 'id' in element.attrib:
+                        self.defs_by_id[element.attrib['id']] = key
+
+        # Entries without an id can't be referenced, so they are always kept. The same for
+        # everything the rest of the document refers to.
+        needed = {key for key in self.defs_entries if 'id' not in self.defs_entries[key].attrib}
+        self.always_needed_defs = self.resolve_defs(self.find_references(skeleton.getroot()), needed)
+
+    def find_references(self, element):
+        references = set()
+        for node in element.iter():
+            if not isinstance(node.tag, str):
+                if node.text and 'url(' in node.text:
+                    references.update(DEFS_URL_REFERENCE.findall(node.text))
+                continue
 
-    def get_layers(self):
+            # <style> elements
+            if node.text and 'url(' in node.text:
+                references.update(DEFS_URL_REFERENCE.findall(node.text))
+
+            for (name, value) in node.attrib.items():
+                if 'url(' in value:
+                    references.update(DEFS_URL_REFERENCE.findall(value))
+                elif (name == 'href' or name.endswith('}href')) and value.startswith('#'):
+                    references.add(value[1:])
+        return references
+
+    # Follow the references through the defs, a gradient may point to another gradient, etc.
+    def resolve_defs(self, references, needed=None):
+        needed = set(needed or ())
+        pending = [self.defs_by_id[reference] for reference in references if reference in self.defs_by_id]
+        pending.extend(needed)
+        while pending:
+            key = pending.pop()
+            needed.add(key)
+            for reference in self.defs_references[key]:
+                referenced_key = self.defs_by_id.get(reference)
+                if referenced_key is not None and referenced_key not in needed:
+                    pending.append(referenced_key)
+        return needed
+
+    def add_layer_defs(self, doc, target_layer):
+        needed = self.resolve_defs(self.find_references(target_layer), self.always_needed_defs)
+
+        for (defs_number, defs) in enumerate(doc.getroot().findall('svg:defs', namespaces=inkex.NSS)):
+            for (child_number, child) in enumerate(self.defs_children[defs_number]):
+                if (defs_number, child_number) in needed:
+                    defs.append(copy.deepcopy(child))
 
-        svg_layers = self.document.xpath('//svg:g[@inkscape:groupmode="layer"]', namespaces=inkex.NSS)
+    def get_layers(self):
+        # One walk over the document, every later stage works with this index
+        self.layer_index = LayerIndex(self.document.getroot())
+        self.temp_elements = []
         layers = []
 
-        for layer in svg_layers:
+        for layer in self.layer_index.layers:
 
-            label_attrib_name = "{%s}label" % layer.nsmap['inkscape']
-            if label_attrib_name not in layer.attrib:
+            if layer.label is None:
                 continue
 
             # Skipping hidden layers
-            if 'style' in layer.attrib:
-                if 'display:none' in layer.attrib['style']:
-                    logging.debug("  Skip: [{}]".format(layer.attrib[label_attrib_name]))
-                    continue
-
-            ## HANDLE TRANSFORM TRANSLATE
-            translate_x = 0.0
-            translate_y = 0.0
-            if "transform" in layer.attrib:
-                if "translate" in layer.attrib["transform"]:
-                    translate_x ,translate_y = layer.attrib["transform"].replace("translate","").replace("(","").replace(")","").split(",")
-                    logging.debug("  Layer has translate: x[{}] y[{}]".format(translate_x, translate_y))
-
-            # Get layer parents, if any
-            parents = []
-            parent  = layer.getparent()
-            while True:
-                if label_attrib_name not in parent.attrib:
-                    break
-                # Found a parent layer
-                # logging.debug("parent: {}".format(parent.attrib["id"]))
-                parents.append(parent.attrib["id"])
-                parent = parent.getparent()
-
-            #default layer_type
-            layer_type = "component"
+            if layer.hidden:
+                logging.debug("  Skip: [{}]".format(layer.label))
+                continue
 
-            # Locked layers get a locked layer_type
-            insensitive_name = "{%s}insensitive" % layer.nsmap['sodipodi']
-            if insensitive_name in layer.attrib:
-                if 'true' in layer.attrib[insensitive_name]:
-                    layer_type = "locked"
-                    self.draw_start_rect(layer, translate_x, translate_y)
+            if layer.translate_x or layer.translate_y:
+                logging.debug("  Layer has translate: x[{}] y[{}]".format(layer.translate_x, layer.translate_y))
 
-            layer_id = layer.attrib["id"]
-            layer_label = layer.attrib[label_attrib_name]
+            # Locked layers get a start rect
+            if layer.type == "locked":
+                self.draw_start_rect(layer.element, layer.translate_x, layer.translate_y)
 
-            logging.debug("  Use : [{}, {}]".format(layer_label, layer_type))
-            layers.append([layer_id, layer_label, layer_type, parents, translate_x, translate_y])
+            logging.debug("  Use : [{}, {}]".format(layer.label, layer.type))
+            layers.append(layer)
 
         logging.debug("  TOTAL NUMBER OF LAYERS: {}\n".format(len(layers)))
         return layers
@@ -279,6 +1937,7 @@ class SVGStencilExporter(inkex.Effect):
                         +','+str(y2) }
 
         line = etree.SubElement(parent, inkex.addNS('path','svg'), line_attribs )
+        self.temp_elements.append(line)
 
     def build_partial_command(self, options):
         command = ['inkscape', '--vacuum-defs']
@@ -288,39 +1947,34 @@ class SVGStencilExporter(inkex.Effect):
         return command
 
     # Delete unwanted layers to create a clean svg file that will be exported
-    def clean_up_target_file(self, target_layer_id, show_layer_ids):
-        # Create a copy of the current document
-        doc = copy.deepcopy(self.document)
-        target_layer_found = False
-        target_layer = None
-
-        # Iterate through all layers in the document
-        for layer in doc.xpath('//svg:g[@inkscape:groupmode="layer"]', namespaces=inkex.NSS):
-            layer_id = layer.attrib["id"]
-            layer_label = layer.attrib["{%s}label" % layer.nsmap['inkscape']]
-
-            # Store the target layer
-            if not target_layer_found and layer_id == target_layer_id:
-                target_layer = layer
-                target_layer_found = True
-
-            # Delete all layers
-            layer.getparent().remove(layer)
-            #logging.debug("    Deleting: [{}, {}]".format(layer_id, layer_label))
+    def clean_up_target_file(self, target_layer_id):
+        # Start from the shared skeleton, it holds everything of the document except the layers
+        doc = copy.deepcopy(self.skeleton)
+
+        layer = self.layer_index.by_id.get(target_layer_id)
+        if layer is None:
+            logging.debug("    Error: Target layer not found [{}]".format(target_layer_id))
+            return False
+
+        # Copy the target layer without its sub layers, they are exported as separate files.
+        # The index knows where they are, the last one first so the other paths stay valid.
+        target_layer = copy.deepcopy(layer.element)
+        for path in reversed(layer.sub_layer_paths):
+            sub_layer = target_layer
+            for index in path:
+                sub_layer = sub_layer[index]
+            sub_layer.getparent().remove(sub_layer)
 
         # Add the target layer as the single layer in the document
-        # This option is used, only when all the layers are deleted above
         root = doc.getroot()
-        if target_layer == None:
-            logging.debug("    Error: Target layer not found [{}]".format(show_layer_ids[0]))
-
         target_layer.attrib['style'] = 'display:inline'
         root.append(target_layer)
 
-        self.mostLeft = 0
-        self.mostRight = 0
-        self.mostTop = 0
-        self.mostBottom = 0
+        # Only the defs the layer refers to
+        self.add_layer_defs(doc, target_layer)
+
+        # Layers are prepared in parallel, so the bounding box is collected per call
+        bbox = {"left": 0, "right": 0, "top": 0, "bottom": 0}
 
         countChildren = 0
         for node in target_layer.iterchildren():
@@ -329,22 +1983,112 @@ class SVGStencilExporter(inkex.Effect):
         if countChildren == 0:
             return False
 
-        for node in target_layer.iterchildren():
-            self.analyseNode(node, countChildren)
-
-        # Save the data in a temporary file
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.svg') as temporary_file:
-            tfile = {
-                    "name":   temporary_file.name,
-                    "left":   self.makeFloat(self.mostLeft),
-                    "top":    self.makeFloat(self.mostTop),
-                    "right":  self.makeFloat(self.mostRight),
-                    "bottom": self.makeFloat(self.mostBottom)
-                    }
+        with self.profiler.stage("analyseNode", target_layer_id):
+            # The inkscape workarounds still change the layer, the engine measures it with
+            # the transforms of the layers and groups around the nodes
+            for node in target_layer.iterchildren():
+                self.analyseNode(node, countChildren)
+            bbox = BoundingBoxEngine().layer_bbox(target_layer, layer.transform) or bbox
+
+        # Position of the layer in the document
+        tfile = {
+                "content": etree.tostring(doc),
+                "document": doc,
+                "layer": target_layer,
+                "left":   self.makeFloat(bbox["left"]),
+                "top":    self.makeFloat(bbox["top"]),
+                "right":  self.makeFloat(bbox["right"]),
+                "bottom": self.makeFloat(bbox["bottom"])
+                }
+        return tfile
+
+    # Only plain shapes are written by the extension itself. Text, filters, markers, clip paths,
+    # masks and clones need the inkscape renderer for a correct drawing area. Paint servers
+    # like gradients and patterns don't change the drawing area.
+    def is_native_layer(self, target_layer):
+        for element in target_layer.iter():
+            # Comments and processing instructions don't end up in the drawing
+            if not isinstance(element.tag, str):
+                continue
+
+            if element.tag not in NATIVE_TAGS:
+                return False
+
+            for name, value in element.attrib.items():
+                if name in NATIVE_BLOCKING_PROPERTIES or name.endswith('}href'):
+                    return False
+
+            style = element.get('style', '')
+            for prop in NATIVE_BLOCKING_PROPERTIES:
+                if prop in style:
+                    return False
+
+        return True
+
+    # Crop the layer document to its visual bounding box and write it as plain svg,
+    # the same as inkscape's --export-plain-svg --export-area-drawing --vacuum-defs
+    def native_component(self, doc, target_layer):
+        area = None
+        for element in target_layer.iter():
+            if not isinstance(element.tag, str) or element.tag not in NATIVE_SHAPE_TAGS:
+                continue
+
+            shape_box = element.bounding_box(element.getparent().composed_transform())
+            if not shape_box:
+                continue
+
+            # Inkscape's visual bounding box includes half the stroke width
+            style = element.specified_style() if hasattr(element, 'specified_style') else element.style
+            if style.get('stroke', 'none') != 'none':
+                stroke_width = inkex.units.parse_unit(str(style.get('stroke-width', '1')))
+                stroke_width = stroke_width[0] if stroke_width else 1.0
+                transform = element.composed_transform()
+                pad = stroke_width / 2 * math.sqrt(abs(transform.a * transform.d - transform.b * transform.c))
+                shape_box = inkex.BoundingBox((shape_box.left - pad, shape_box.right + pad), (shape_box.top - pad, shape_box.bottom + pad))
+
+            area = shape_box if area is None else area + shape_box
+
+        if not area:
+            return None
+
+        root = doc.getroot()
 
-            logging.debug("    Creating temp file {}".format(temporary_file.name))
-            doc.write(temporary_file.name)
-            return tfile
+        # Scale of the user units, so width and height keep the unit of the document
+        scale_x, scale_y, unit = 1.0, 1.0, ''
+        view_box = root.get('viewBox')
+        width = inkex.units.parse_unit(root.get('width', ''))
+        height = inkex.units.parse_unit(root.get('height', ''))
+        if view_box and width and height:
+            view_box = [float(value) for value in re.split(r'[\s,]+', view_box.strip())]
+            if len(view_box) == 4 and view_box[2] and view_box[3]:
+                scale_x = width[0] / view_box[2]
+                scale_y = height[0] / view_box[3]
+                unit = width[1]
+
+        # Rounded, curves are measured on their bezier approximation
+        root.set('width', "{:g}{}".format(round(area.width * scale_x, 3), unit))
+        root.set('height', "{:g}{}".format(round(area.height * scale_y, 3), unit))
+        root.set('viewBox', " ".join("{:g}".format(round(value, 3)) for value in (area.left, area.top, area.width, area.height)))
+
+        # Plain svg: no inkscape or sodipodi elements and attributes
+        editor_namespaces = ('{%s}' % inkex.NSS['inkscape'], '{%s}' % inkex.NSS['sodipodi'])
+        for element in list(root.iter()):
+            if not isinstance(element.tag, str):
+                continue
+            if element.tag.startswith(editor_namespaces):
+                element.getparent().remove(element)
+                continue
+            for name in list(element.attrib):
+                if name.startswith(editor_namespaces):
+                    del element.attrib[name]
+
+        # The defs were already reduced to the ones the layer uses, see add_layer_defs
+        for defs in root.findall('svg:defs', namespaces=inkex.NSS):
+            if len(defs) == 0:
+                root.remove(defs)
+
+        etree.cleanup_namespaces(doc)
+        return etree.tostring(doc, xml_declaration=True, encoding='UTF-8')
 
     # gather bounding box info to export
     def analyseNode(self, node, countChildren):
@@ -360,6 +2104,7 @@ class SVGStencilExporter(inkex.Effect):
         else:
             self.getMaxGeo(node, countChildren)
 
+    # Only the workarounds, the bounding box is measured by BoundingBoxEngine
     def getMaxGeo(self, node, countChildren):
 
         temp_store_style = ""
@@ -380,62 +2125,38 @@ class SVGStencilExporter(inkex.Effect):
 
         if node.typename == 'TextElement':
             # WORKAROUNDS FOR A INKSCAPE BBOX BUG
-            for tspan in node.xpath('//svg:tspan', namespaces=inkex.NSS):
-                node.attrib["x"] = tspan.attrib["x"]
-                node.attrib["y"] = tspan.attrib["y"]
-
-                if "x" not in node.attrib or "y" not in node.attrib:
-                    logging.debug("REPAIRING MISSING TEXT  X,Y")
-                    node.attrib["x"] = tspan.attrib["x"]
-                    node.attrib["y"] = tspan.attrib["y"]
+            # Only the tspans of this text element, in a single pass. The text gets the
+            # position of its last positioned tspan, the first one is moved up by the font size.
+            first_tspan = None
+            last_tspan = None
+            for tspan in node.iterchildren(inkex.addNS('tspan', 'svg')):
+                if "x" not in tspan.attrib or "y" not in tspan.attrib:
+                    continue
+                if first_tspan is None:
+                    first_tspan = tspan
+                last_tspan = tspan
 
-                if node.attrib["x"] != tspan.attrib["x"] or node.attrib["y"] != tspan.attrib["y"]:
+            if last_tspan is not None:
+                if node.get("x") != last_tspan.attrib["x"] or node.get("y") != last_tspan.attrib["y"]:
                     logging.debug("REPAIRING TEXT X,Y, NON EQ WITH TSPAN X,Y")
 
-                    node.attrib["x"] = tspan.attrib["x"]
-                    node.attrib["y"] = tspan.attrib["y"]
-
-            if countChildren == 1:
-                for tspan in node.xpath('//svg:tspan', namespaces=inkex.NSS):
-                    # GET FONT SIZE FOR CHANGING TEXT Y POSITION BASED ON FONT SIZE
-                    font_size = "0"
+                    node.attrib["x"] = last_tspan.attrib["x"]
+                    node.attrib["y"] = last_tspan.attrib["y"]
 
-                    if "font-size" in node.attrib:
-                        logging.debug("FONT SIZE IN ATTRIB")
-                        logging.debug(node.attrib["font-size"])
-                        font_size = node.attrib["font-size"].replace("px","")
-                    elif "style" in node.attrib and "font-size" in node.attrib["style"]:
-                        logging.debug("FONT SIZE IN STYLE")
-                        logging.debug(node.attrib["style"].split("font-size")[1].split(";")[0])
-                        font_size = node.attrib["style"].split("font-size")[1].split(";")[0].replace(":","").replace("px","")
+            if countChildren == 1 and first_tspan is not None:
+                # GET FONT SIZE FOR CHANGING TEXT Y POSITION BASED ON FONT SIZE
+                font_size = "0"
 
-                    tspan.attrib["y"] = str(self.makeFloat(tspan.attrib["y"]) - self.makeFloat(font_size))
-                    break
-
-        bbox = node.shape_box()
-        if not bbox:
-            return
-
-        logging.debug(['typename',node.typename])
-        logging.debug(['shape_box',node.shape_box()])
-
-        left = bbox.left
-        top = bbox.top
-        width = bbox.width
-        height = bbox.height
-
-        if self.mostRight == 0 or (left + width) > self.mostRight:
-            self.mostRight = left + width
-
-        if self.mostBottom == 0 or (top + height) > self.mostBottom:
-            self.mostBottom = top + height
-
-        if self.mostLeft == 0 or left < self.mostLeft:
-            self.mostLeft = left
-
-        if self.mostTop == 0 or top < self.mostTop:
-            self.mostTop = top
+                if "font-size" in node.attrib:
+                    logging.debug("FONT SIZE IN ATTRIB")
+                    logging.debug(node.attrib["font-size"])
+                    font_size = node.attrib["font-size"].replace("px","")
+                elif "style" in node.attrib and "font-size" in node.attrib["style"]:
+                    logging.debug("FONT SIZE IN STYLE")
+                    logging.debug(node.attrib["style"].split("font-size")[1].split(";")[0])
+                    font_size = node.attrib["style"].split("font-size")[1].split(";")[0].replace(":","").replace("px","")
 
+                first_tspan.attrib["y"] = str(self.makeFloat(first_tspan.attrib["y"]) - self.makeFloat(font_size))
 
     def makeFloat(self, var):
         if var is None:
@@ -448,25 +2169,116 @@ class SVGStencilExporter(inkex.Effect):
 
         return round(float(var),2)
 
-    def export_to_file(self, command, svg_path, output_path, use_logging):
-        command.append('--export-filename=%s' % output_path)
-        command.append(svg_path)
-        logging.debug("    {}\n".format(' '.join(command)))
+    # The layer is piped to inkscape and the result read from its stdout, the component
+    # file is only written when the export succeeded
+    # Returns "exported", "failed" or "timeout"
+    def export_to_file(self, command, content, output_path, use_logging, timeout=300):
+        command.append('--pipe')
+        command.append('--export-filename=-')
+        logging.debug("    {} > {}\n".format(' '.join(command), output_path))
+
+        # If not piped, stderr will be showed in an inkscape dialog at the end.
+        # Inkscape export will create A LOT of warnings, most of them repeated, and I believe
+        # it is pointless to crowd the log file with these warnings.
+        stderr = None if use_logging else subprocess.DEVNULL
 
         try:
-            if use_logging:
-                # If not piped, stdout and stderr will be showed in an inkscape dialog at the end.
-                # Inkscape export will create A LOT of warnings, most of them repeated, and I believe
-                # it is pointless to crowd the log file with these warnings.
-                with subprocess.Popen(command) as proc:
-                    proc.wait(timeout=300)
-            else:
-                with subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) as proc:
-                    proc.wait(timeout=300)
+            # Run in the output folder, relative links in the layer (shared assets) resolve from there
+            proc = run_process(command, timeout, input=content, stderr=stderr,
+                               cwd=os.path.dirname(os.path.abspath(output_path)))
+        except subprocess.TimeoutExpired:
+            logging.debug('Timeout while exporting file {}.'.format(output_path))
+            return "timeout"
+        except OSError:
+            logging.debug('Error while exporting file {}.'.format(command))
+            return "failed"
+
+        if proc.returncode != 0 or not proc.stdout:
+            logging.debug('Error while exporting file {}.'.format(output_path))
+            return "failed"
+
+        self.write_atomic(output_path, proc.stdout)
+        return "exported"
+
+    # One inkscape shell per worker, handed out through a queue
+    def create_shell_pool(self, options):
+        if not options.use_inkscape_shell:
+            return None
+
+        shells = queue.Queue()
+        for i in range(options.workers):
+            shells.put(InkscapeShell(options.use_logging, options.export_timeout))
+        return shells
+
+    def close_shell_pool(self, shells):
+        if shells is None:
+            return
+
+        while not shells.empty():
+            shells.get().close()
+
+    def export_png_to_file(self, svg_path, output_path, size, use_logging, timeout=300):
+        # The png goes to stdout, as the layers in export_to_file
+        command = ['inkscape', '--export-type=png', '--export-area-page', '--export-{}={}'.format(*size),
+                   '--export-filename=-', svg_path]
+        logging.debug("    {} > {}\n".format(' '.join(command), output_path))
+        stderr = None if use_logging else subprocess.DEVNULL
+
+        try:
+            proc = run_process(command, timeout, stderr=stderr)
+        except subprocess.TimeoutExpired:
+            logging.debug('Timeout while exporting file {}.'.format(output_path))
+            return False
         except OSError:
             logging.debug('Error while exporting file {}.'.format(command))
-            inkex.errormsg('Error while exporting file {}.'.format(command))
-            exit()
+            return False
+
+        if proc.returncode != 0 or not proc.stdout:
+            logging.debug('Error while exporting file {}.'.format(output_path))
+            return False
+
+        self.write_atomic(output_path, proc.stdout)
+        return True
+
+    def export_png_with_pool(self, options, shells, svg_path, output_path, size):
+        if shells is not None:
+            shell = shells.get()
+            try:
+                if shell.proc is not None or shell.start():
+                    output = shell.export_png(svg_path, size)
+                    if output is not None:
+                        self.write_atomic(output_path, output)
+                        return True
+                logging.debug("  Shell export failed for {}, retrying with a separate process".format(output_path))
+            except OSError:
+                logging.debug('Error while starting the inkscape shell.')
+            finally:
+                shells.put(shell)
+
+        return self.export_png_to_file(svg_path, output_path, size, options.use_logging, options.export_timeout)
+
+    # Returns "exported", "failed" or "timeout", see export_layer
+    def export_with_pool(self, options, command, shells, content, destination_path, timeout):
+        if shells is not None:
+            shell = shells.get()
+            try:
+                # Shells are started on first use, so small stencils don't start more than they need
+                if shell.proc is not None or shell.start():
+                    # Shared assets are linked relative to the components
+                    layer_folder = os.path.dirname(destination_path) if options.shared_assets else None
+                    (status, output) = shell.export(content, timeout, layer_folder)
+                    if status == "exported":
+                        self.write_atomic(destination_path, output)
+                    # A separate process wouldn't be any faster, the next attempt gets more time
+                    if status != "failed":
+                        return status
+                logging.debug("  Shell export failed for {}, retrying with a separate process".format(destination_path))
+            except OSError:
+                logging.debug('Error while starting the inkscape shell.')
+            finally:
+                shells.put(shell)
+
+        return self.export_to_file(command.copy(), content, destination_path, options.use_logging, timeout)
 
     def writeGitHubAction(self, options):
         if options.create_github_action:
@@ -497,13 +2309,16 @@ jobs:
         with:
           github_token: ${{ secrets.GITHUB_TOKEN }}
           publish_dir: .
-
+PRECOMPRESSED_EXCLUDE
 """
+            # GitHub Pages compresses by itself and never serves .gz or .br files, leave them out
+            if options.precompress:
+                gh_action_yaml = gh_action_yaml.replace("PRECOMPRESSED_EXCLUDE", "          exclude_assets: '.github,**/*.gz,**/*.br'\n")
+            else:
+                gh_action_yaml = gh_action_yaml.replace("PRECOMPRESSED_EXCLUDE", "")
             destination_gh_action_yaml = os.path.join(ghdir , "gh-pages.yml")
 
-            ymlfile = open(destination_gh_action_yaml, 'w')
-            ymlfile.write(gh_action_yaml)
-            ymlfile.close()
+            self.write_if_changed(destination_gh_action_yaml, gh_action_yaml.encode())
 
 
     ########################
@@ -518,17 +2333,23 @@ jobs:
     - cp -r * .public
     - rm -rf public
     - mv .public public
-  artifacts:
+PRECOMPRESSED_STEP  artifacts:
     paths:
       - public
   rules:
     - if: $CI_COMMIT_BRANCH == $CI_DEFAULT_BRANCH
 """
+            # GitLab Pages serves the .gz and .br files next to a requested file to browsers that
+            # accept them. Files without one, e.g. added by hand, get a .gz here.
+            if options.precompress:
+                gl_action_yaml = gl_action_yaml.replace("PRECOMPRESSED_STEP", """    - find public -type f \\( -name '*.svg' -o -name '*.json' -o -name '*.html' \\) ! -exec test -e '{}.gz' \\; -exec gzip -k -9 '{}' \\;
+""")
+            else:
+                gl_action_yaml = gl_action_yaml.replace("PRECOMPRESSED_STEP", "")
+
             destination_gl_action_yaml = os.path.join(options.output_path , ".gitlab-ci.yml")
 
-            ymlfile = open(destination_gl_action_yaml, 'w')
-            ymlfile.write(gl_action_yaml)
-            ymlfile.close()
+            self.write_if_changed(destination_gl_action_yaml, gl_action_yaml.encode())
 
     ########################
     ########################
@@ -547,15 +2368,71 @@ License: {options.stencil_license_url}
 """
             destination_indexmd = os.path.join(options.output_path , "readme.md")
 
-            mdfile = open(destination_indexmd, 'w')
-            mdfile.write(indexmd)
-            mdfile.close()
+            self.write_if_changed(destination_indexmd, indexmd.encode())
 
-    def writeHTML(self, options, components_list):
+    def writeHTML(self, options, components_list, components_data=None):
         if options.create_cover_page:
 
             htmldesc = options.stencil_description.replace("\\n","<br>")
 
+            # Large stencils would load every component at once. Only one page of previews is in the
+            # document and the images load when they scroll into view, thumbnails when there are any.
+            # The list is written into the page so it also works when opened from disk.
+            componentsjs = '''
+  <script>
+    const pageSize = PAGE_SIZE
+    const stencil = INLINE_COMPONENTS
+
+    function componentUrl(path) {
+      return path.split('/').map(encodeURIComponent).join('/')
+    }
+
+    function currentPage() {
+      const match = window.location.hash.match(/page=(\\d+)/)
+      return match ? parseInt(match[1]) : 1
+    }
+
+    function showPage(page) {
+      const pages = Math.max(1, Math.ceil(stencil.components.length / pageSize))
+      page = Math.min(Math.max(page, 1), pages)
+      const data = stencil.components_data
+
+      const row = document.getElementById('components')
+      row.innerHTML = ''
+      for (const comp of stencil.components.slice((page - 1) * pageSize, page * pageSize)) {
+        const img = document.createElement('img')
+        img.loading = 'lazy'
+        img.decoding = 'async'
+        img.className = 'img-thumbnail'
+        img.style.maxWidth = '200px'
+        img.alt = comp
+        img.src = componentUrl((data[comp] && data[comp].thumbnail) || comp)
+        const col = document.createElement('div')
+        col.className = 'col-sm'
+        col.appendChild(img)
+        row.appendChild(col)
+      }
+
+      const pager = document.getElementById('pager')
+      pager.innerHTML = ''
+      if (pages == 1) return
+      for (const [label, target] of [['Previous', page - 1], [page + ' / ' + pages, page], ['Next', page + 1]]) {
+        const item = document.createElement('li')
+        item.className = 'page-item' + (target < 1 || target > pages ? ' disabled' : '') + (target == page ? ' active' : '')
+        const link = document.createElement('a')
+        link.className = 'page-link'
+        link.href = '#page=' + target
+        link.textContent = label
+        item.appendChild(link)
+        pager.appendChild(item)
+      }
+    }
+
+    showPage(currentPage())
+    window.addEventListener('hashchange', () => showPage(currentPage()))
+  </script>
+'''
+
             htmljs = '''
   <script>
     switch(window.location.protocol) {
@@ -573,8 +2450,24 @@ License: {options.stencil_license_url}
         '''
 
             compstr=""
-            for comp in components_list:
-                compstr=compstr+'<div class="col-sm"> <img style="max-width:200px;" class="img-thumbnail" src="'+comp+'" /></div>'
+            if options.cover_page_mode == "sprite":
+                for comp in components_list:
+                    if comp in self.sprite_symbols:
+                        # Every preview refers to the same file, the browser loads it once
+                        (symbol_id, view_box) = self.sprite_symbols[comp]
+                        (x, y, width, height) = view_box.replace(',', ' ').split()
+                        compstr=compstr+'<div class="col-sm"> <svg style="max-width:200px;max-height:200px;" class="img-thumbnail" width="'+width+'" height="'+height+'" viewBox="'+view_box+'"><use href="'+SPRITE_FILE+'#'+symbol_id+'" x="'+x+'" y="'+y+'" width="'+width+'" height="'+height+'"/></svg></div>'
+                    else:
+                        compstr=compstr+'<div class="col-sm"> <img style="max-width:200px;" class="img-thumbnail" src="'+comp+'" /></div>'
+            else:
+                # The first page is in the document for browsers without scripts, the script
+                # shows the other pages. Only the thumbnails are taken from components_data.
+                thumbnails = {comp: {"thumbnail": data["thumbnail"]} for (comp, data) in (components_data or {}).items() if data.get("thumbnail")}
+                for comp in components_list[:COVER_PAGE_SIZE]:
+                    src = urllib.parse.quote(thumbnails.get(comp, {}).get("thumbnail", comp))
+                    compstr=compstr+'<div class="col-sm"> <img loading="lazy" decoding="async" style="max-width:200px;" class="img-thumbnail" alt="'+html.escape(comp)+'" src="'+src+'" /></div>'
+                inline_components = json.dumps({"components": components_list, "components_data": thumbnails}).replace("</", "<\\/")
+                htmljs = htmljs + componentsjs.replace("INLINE_COMPONENTS", inline_components).replace("PAGE_SIZE", str(COVER_PAGE_SIZE))
 
             indexhtml = f"""<html>
   <head>
@@ -593,19 +2486,17 @@ License: {options.stencil_license_url}
         <div id="helpText"></div>
       </div>
       <hr>
-      <div class="row m-3">
+      <div class="row m-3" id="components">
           {compstr}
       </div>
+      <nav><ul class="pagination justify-content-center" id="pager"></ul></nav>
     </div>
     {htmljs}
   </body>
 </html>
 """
             destination_indexhtml = os.path.join(options.output_path , "index.html")
-
-            htmlfile = open(destination_indexhtml, 'w')
-            htmlfile.write(indexhtml)
-            htmlfile.close()
+            self.write_if_changed(destination_indexhtml, indexhtml.encode())
 
     ########################
     ########################
@@ -615,51 +2506,120 @@ License: {options.stencil_license_url}
             parent_dir = os.path.dirname(options.output_path)
             parent_meta_json = os.path.join(parent_dir, "stencil-meta.json")
             if os.path.exists(parent_meta_json):
-                shutil.copyfile(parent_meta_json, os.path.join(options.output_path,"stencil-meta.json"))
+                with open(parent_meta_json, 'rb') as json_file:
+                    self.write_if_changed(os.path.join(options.output_path, "stencil-meta.json"), json_file.read())
+
+    # Compressed copies of the published files for static hosts that serve them as they are,
+    # like GitLab Pages. A file is only compressed again when its content changed since its
+    # sidecars were written, the hashes are kept in .stencil-precompressed.json.
+    def writePrecompressed(self, options, components_list):
+        if not options.precompress:
+            return
 
-    def writeParentHTML(self, options ):
+        manifest_path = os.path.join(options.output_path, PRECOMPRESSED_MANIFEST)
+        try:
+            with open(manifest_path) as json_file:
+                hashes = json.load(json_file)["files"]
+        except (OSError, ValueError, KeyError):
+            hashes = {}
+
+        file_names = list(components_list) + [file_name for file_name in PRECOMPRESSED_FILES if file_name not in components_list]
+        file_names = [file_name for file_name in file_names if os.path.exists(os.path.join(options.output_path, file_name))]
+
+        # zlib and brotli release the GIL, the files are compressed in parallel
+        with concurrent.futures.ThreadPoolExecutor(max_workers=options.workers) as pool:
+            compressed = list(pool.map(lambda file_name: self.compress_file(options, file_name, hashes.get(file_name)), file_names))
+        logging.debug("  Precompressed {} of {} files".format(sum(written for (content_hash, written) in compressed), len(file_names)))
+
+        # Sidecars of files that are gone, e.g. removed components
+        for file_name in set(hashes) - set(file_names):
+            if os.path.exists(os.path.join(options.output_path, file_name)):
+                continue
+            for extension in PRECOMPRESSED_EXTENSIONS:
+                sidecar_path = os.path.join(options.output_path, file_name + extension)
+                if os.path.exists(sidecar_path):
+                    logging.debug("  Removing old compressed copy {}".format(sidecar_path))
+                    os.remove(sidecar_path)
+
+        hashes = {file_name: content_hash for (file_name, (content_hash, written)) in zip(file_names, compressed)}
+        self.write_if_changed(manifest_path, json.dumps({"files": hashes}, indent=1, sort_keys=True).encode())
+
+    # Returns the hash of the file and the number of sidecars written
+    def compress_file(self, options, file_name, known_hash):
+        compressors = [('.gz', lambda content: gzip.compress(content, compresslevel=9, mtime=0))]
+        if brotli is not None:
+            compressors.append(('.br', lambda content: brotli.compress(content)))
+
+        path = os.path.join(options.output_path, file_name)
+        with open(path, 'rb') as source_file:
+            content = source_file.read()
+        content_hash = hashlib.sha256(content).hexdigest()
+
+        written = 0
+        for (extension, compress) in compressors:
+            sidecar_path = path + extension
+            if content_hash == known_hash and os.path.exists(sidecar_path):
+                continue
+            self.write_atomic(sidecar_path, compress(content))
+            written += 1
+        return (content_hash, written)
+
+    # The parent index lists the stencils next to this one. Their name, author and number of
+    # components are kept in stencils-index.json in the parent folder, only the entries of the
+    # exported stencils are updated and the page is rendered from that file. The sibling folders
+    # are only searched when there is no stencils-index.json yet.
+    def writeParentHTML(self, options, exported=None):
         if options.update_parent_index:
 
             parent_dir = os.path.dirname(options.output_path)
             parent_meta_json = os.path.join(parent_dir, "stencil-meta.json")
+            index_json = os.path.join(parent_dir, "stencils-index.json")
 
-            stencil_dirs = glob.glob(parent_dir+'/*/stencil-meta.json', recursive=True)
-            logging.debug("  Glob: {}".format(stencil_dirs))
-
-            jsstr = '''
-fetch("./stencil-meta.json")
-  .then(response => response.json())
-  .then((json) => {
-    console.log(json)
-    if(json.name){
-    document.title = json.name
-        document.getElementById("jsonTitle").innerHTML = json.name
-    }
+            stencils = self.read_parent_index(index_json)
+            if stencils is None:
+                stencil_dirs = glob.glob(parent_dir+'/*/stencil-meta.json', recursive=True)
+                logging.debug("  Glob: {}".format(stencil_dirs))
+                stencils = {}
+                for stencildir in stencil_dirs:
+                    self.update_parent_index_entry(stencils, os.path.dirname(stencildir))
 
-    if(json.description) document.getElementById("jsonDesc").innerHTML = json.description
-    if(json.author) document.getElementById("jsonAuthor").innerHTML = "Author: " + json.author
-  });
-'''
+            for stencil_options in (exported or [options]):
+                self.update_parent_index_entry(stencils, stencil_options.output_path)
+
+            self.write_if_changed(index_json, json.dumps({"stencils": stencils}, indent=1, sort_keys=True).encode())
+
+            # The title of the page comes from the stencil-meta.json of the parent folder
+            parent_meta = {}
+            if os.path.exists(parent_meta_json):
+                try:
+                    with open(parent_meta_json) as json_file:
+                        parent_meta = json.load(json_file)
+                except (OSError, ValueError):
+                    logging.debug("  Ignoring unreadable {}".format(parent_meta_json))
+
+            title = html.escape(parent_meta.get("name") or "STENCILS")
+            heading = html.escape(parent_meta.get("name") or "")
+            author = "Author: " + html.escape(parent_meta["author"]) if parent_meta.get("author") else ""
+            description = html.escape(parent_meta.get("description") or "")
 
             stencil_str=""
-            for stencildir in stencil_dirs:
-                stencil = os.path.basename(os.path.dirname(stencildir))
-                stencil_str=stencil_str + '<li><a href="./'+stencil+'">'+stencil+'</a></li>'
+            for (stencil, entry) in sorted(stencils.items()):
+                details = html.escape(entry.get("author") or "")
+                if entry.get("components") is not None:
+                    details = (details + ", " if details else "") + "{} components".format(entry["components"])
+                stencil_str=stencil_str + '<li><a href="./'+html.escape(stencil)+'">'+html.escape(entry.get("name") or stencil)+'</a> <small class="text-muted">'+details+'</small></li>'
 
 
             indexhtml = f"""<html>
   <head>
-    <title>STENCILS</title>
-    <script>
-    {jsstr}
-    </script>
+    <title>{title}</title>
     <link href="https://cdn.jsdelivr.net/npm/bootstrap@5.1.3/dist/css/bootstrap.min.css" rel="stylesheet" integrity="sha384-1BmE4kWBq78iYhFldvKuhfTAU6auU8tT94WrHftjDbrCEXSU1oBoqyl2QvZ6jIW3" crossorigin="anonymous">
   </head>
   <body>
     <div class="container">
-      <h1 id="jsonTitle"></h1>
-      <p><span id="jsonAuthor"></span><br/></p>
-        <p id="jsonDesc"></p>
+      <h1 id="jsonTitle">{heading}</h1>
+      <p><span id="jsonAuthor">{author}</span><br/></p>
+        <p id="jsonDesc">{description}</p>
     <hr>
       <div class="row m-3">
       <ul>
@@ -671,13 +2631,379 @@ fetch("./stencil-meta.json")
 </html>
 """
             destination_indexhtml = os.path.join(parent_dir , "index.html")
+            self.write_if_changed(destination_indexhtml, indexhtml.encode())
 
-            htmlfile = open(destination_indexhtml, 'w')
-            htmlfile.write(indexhtml)
-            htmlfile.close()
+    def read_parent_index(self, index_json):
+        if not os.path.exists(index_json):
+            return None
+        try:
+            with open(index_json) as json_file:
+                return json.load(json_file)["stencils"]
+        except (OSError, ValueError, KeyError):
+            logging.debug("  Rebuilding unreadable {}".format(index_json))
+            return None
+
+    # Stencils without a stencil-meta.json aren't listed, as before there was an index file
+    def update_parent_index_entry(self, stencils, stencil_path):
+        stencil = os.path.basename(os.path.normpath(stencil_path))
+        meta_json = os.path.join(stencil_path, "stencil-meta.json")
+        components_json = os.path.join(stencil_path, "stencil-components.json")
+
+        try:
+            with open(meta_json) as json_file:
+                meta = json.load(json_file)
+        except (OSError, ValueError):
+            stencils.pop(stencil, None)
+            return
+
+        components = None
+        mtime = os.path.getmtime(meta_json)
+        if os.path.exists(components_json):
+            try:
+                with open(components_json) as json_file:
+                    components = len(json.load(json_file).get("components", []))
+                mtime = max(mtime, os.path.getmtime(components_json))
+            except (OSError, ValueError):
+                logging.debug("  Ignoring unreadable {}".format(components_json))
+
+        stencils[stencil] = {
+                "name": meta.get("name", stencil),
+                "author": meta.get("author", ""),
+                "components": components,
+                "mtime": int(mtime),
+                }
+
+# Summary of the command line modes. Inkscape shows anything on stderr in a dialog, the
+# extension itself only logs the written files.
+def report_written_files(paths):
+    inkex.errormsg('Files written: {}'.format(', '.join(paths) if paths else 'none, all generated files were up to date.'))
+
+class BatchExport():
+    """Export a whole directory of stencil documents without inkscape's extension dialog.
+
+    Every source file is exported to a folder named after it in --path. Its stencil-meta.json,
+    if there is one already, provides the meta information. All documents share one pool of
+    workers and inkscape processes, and the parent index is written once at the end.
+    """
+
+    META_OPTIONS = {
+            "name": "stencil_name",
+            "author": "stencil_author",
+            "description": "stencil_description",
+            "homepage": "stencil_homepage",
+            "license": "stencil_license_url",
+            }
+
+    def __init__(self, args):
+        self.args = args
+        self.main_exporter = SVGStencilExporter()
+        self.main_exporter.parse_arguments(args)
+
+    def find_sources(self):
+        sources = []
+        for pattern in self.main_exporter.options.batch:
+            if os.path.isdir(pattern):
+                pattern = os.path.join(pattern, '*.svg')
+            sources.extend(sorted(glob.glob(pattern)))
+
+        # The same file may match more than one pattern
+        return list(dict.fromkeys(os.path.abspath(source) for source in sources))
+
+    def create_exporter(self, source):
+        output_root = os.path.normpath(self.main_exporter.options.path)
+        output_path = os.path.join(output_root, os.path.splitext(os.path.basename(source))[0])
+
+        exporter = SVGStencilExporter()
+        exporter.parse_arguments(self.args + [source])
+        exporter.options.path = output_path
+        exporter.options.batch = []
+
+        meta_json = os.path.join(output_path, "stencil-meta.json")
+        if os.path.exists(meta_json):
+            with open(meta_json) as json_file:
+                meta = json.load(json_file)
+            for (key, option) in self.META_OPTIONS.items():
+                if meta.get(key):
+                    setattr(exporter.options, option, meta[key])
+
+        return exporter
+
+    def export_document(self, exporter, pool, shells):
+        options = Options(exporter)
+        if not os.path.exists(options.output_path):
+            os.makedirs(options.output_path)
+
+        logging.debug(options)
+        exporter.profiler = Profiler(options.write_profile, options.workers)
+        exporter.load_raw()
+        try:
+            results = exporter.export_layers(options, pool, shells)
+            exporter.write_outputs(options, results)
+        finally:
+            exporter.clean_up()
+        exporter.log_touched_files()
+        exporter.profiler.write(options.output_path)
+        return options
+
+    def run(self):
+        sources = self.find_sources()
+        if not sources:
+            inkex.errormsg('No stencil documents found for {}.'.format(', '.join(self.main_exporter.options.batch)))
+            return 1
+
+        exporters = [self.create_exporter(source) for source in sources]
+        main_options = Options(exporters[0])
+
+        shells = self.main_exporter.create_shell_pool(main_options)
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=main_options.workers) as pool:
+                # The documents only wait for their own layers, the pool does the work
+                with concurrent.futures.ThreadPoolExecutor(max_workers=main_options.workers) as documents:
+                    futures = [documents.submit(self.export_document, exporter, pool, shells) for exporter in exporters]
+                    all_options = [future.result() for future in futures]
+        finally:
+            self.main_exporter.close_shell_pool(shells)
+
+        # All stencils share the same parent folder, its index is written once
+        self.main_exporter.writeParentHTML(all_options[0], all_options)
+        self.main_exporter.log_touched_files()
+
+        report_written_files([path for exporter in exporters + [self.main_exporter] for path in exporter.published_files()])
+        inkex.errormsg('Exported {} stencils to {}.'.format(len(sources), os.path.normpath(self.main_exporter.options.path)))
+        return 0
+
+class WatchExport():
+    """Export a stencil document again every time it's saved, until the command is interrupted.
+
+    The worker pool and the inkscape shells stay up between exports and the export cache finds
+    the layers that changed, so a save only costs the changed layers. Components that no layer
+    has anymore, because the layer was removed, renamed or moved, are deleted.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.main_exporter = SVGStencilExporter()
+        self.main_exporter.parse_arguments(args)
+        self.source = self.main_exporter.options.input_file
+        self.interval = max(0.1, self.main_exporter.options.watch_interval)
+        # Component files of the previous export
+        self.components = None
+        # Generated files written by the last export
+        self.touched_files = []
+
+    def create_exporter(self):
+        exporter = SVGStencilExporter()
+        exporter.parse_arguments(self.args)
+        # Changed layers are found through the export cache and always written again
+        exporter.options.use_export_cache = True
+        exporter.options.overwrite_files = True
+        return exporter
+
+    def source_state(self):
+        try:
+            stat = os.stat(self.source)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def export(self, pool, shells):
+        exporter = self.create_exporter()
+        options = Options(exporter)
+        exporter.profiler = Profiler(options.write_profile, options.workers)
+
+        # Before the first export, the components of the last export are in the export cache
+        if self.components is None:
+            self.components = {layer["file_name"] for layer in exporter.read_manifest(options).values()}
+
+        exporter.load_raw()
+        try:
+            results = exporter.export_layers(options, pool, shells)
+            exporter.write_outputs(options, results)
+            exporter.writeParentHTML(options)
+        finally:
+            exporter.clean_up()
+        exporter.log_touched_files()
+        self.touched_files = exporter.published_files()
+        exporter.profiler.write(options.output_path)
+
+        self.remove_old_components(options, results)
+        return results
+
+    def remove_old_components(self, options, results):
+        # Failed exports keep their old file
+        components = {result["file_name"] for result in results if result and not result["duplicate_of"]}
+
+        for file_name in self.components - components:
+            for path in (file_name,) + tuple(file_name + extension for extension in PRECOMPRESSED_EXTENSIONS):
+                path = os.path.join(options.output_path, path)
+                if os.path.exists(path):
+                    logging.debug("  Removing old component {}".format(path))
+                    os.remove(path)
+        self.components = components
+
+    def run(self):
+        if not self.source or not os.path.exists(self.source):
+            inkex.errormsg('No stencil document to watch.')
+            return 1
+
+        # The log file is written to the output folder
+        output_path = os.path.normpath(self.main_exporter.options.path)
+        if not os.path.exists(output_path):
+            os.makedirs(output_path)
+        main_options = Options(self.create_exporter())
+
+        inkex.errormsg('Watching {}, stop with Ctrl+C.'.format(self.source))
+        shells = self.main_exporter.create_shell_pool(main_options)
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=main_options.workers) as pool:
+                exported_state = None
+                while True:
+                    state = self.source_state()
+                    if state is not None and state != exported_state:
+                        # Inkscape may still be writing the file, wait until it stops changing
+                        time.sleep(self.interval)
+                        if self.source_state() != state:
+                            continue
+
+                        exported_state = state
+                        start = time.perf_counter()
+                        try:
+                            results = self.export(pool, shells)
+                        except (etree.XMLSyntaxError, OSError, ValueError) as error:
+                            inkex.errormsg('Export of {} failed: {}'.format(self.source, error))
+                        else:
+                            layers = [result for result in results if result]
+                            changed = [result for result in layers if result["action"] in ("export", "native")]
+                            inkex.errormsg('Exported {} of {} layers in {:.1f}s, {} other files updated.'.format(
+                                len(changed), len(layers), time.perf_counter() - start, len(self.touched_files)))
+                            report_written_files(self.touched_files)
+
+                    time.sleep(self.interval)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.main_exporter.close_shell_pool(shells)
+        return 0
+
+class ExportServer():
+    """Run the exports of the extension in one long lived process, see ExportClient in
+    svg_stencil_export_client.py.
+
+    Every run of the extension from Inkscape starts a new Python process, imports inkex and
+    starts new inkscape processes. The server does that once: it keeps the imports, the
+    bounding boxes of BoundingBoxEngine and the inkscape shells between the runs, and runs one
+    job at a time. It stops when no job came in for --server-idle-timeout seconds.
+    """
+
+    def __init__(self, args):
+        self.main_exporter = SVGStencilExporter()
+        self.main_exporter.parse_arguments(args)
+        self.idle_timeout = max(1.0, self.main_exporter.options.server_idle_timeout)
+        self.socket_path = export_server_socket_path()
+        self.version = export_server_version()
+        self.shells = None
+        self.shells_key = None
+
+    # The shells of the last job are used again when the next one wants the same kind
+    def shell_pool(self, options):
+        key = (options.use_inkscape_shell, options.workers, options.use_logging, options.export_timeout)
+        if key != self.shells_key:
+            self.main_exporter.close_shell_pool(self.shells)
+            self.shells = self.main_exporter.create_shell_pool(options)
+            self.shells_key = key
+        return self.shells
+
+    def run(self):
+        if self.socket_path is None:
+            return 1
+
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            # A socket file without a server behind it is left over from a server that died
+            if os.path.exists(self.socket_path):
+                if export_server_connect(self.socket_path) is not None:
+                    return 0
+                os.remove(self.socket_path)
+            listener.bind(self.socket_path)
+            listener.listen()
+            listener.settimeout(self.idle_timeout)
+
+            while True:
+                try:
+                    connection, _ = listener.accept()
+                except socket.timeout:
+                    break
+                with connection:
+                    connection.settimeout(None)
+                    if not self.handle(connection):
+                        break
+        finally:
+            listener.close()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+            self.main_exporter.close_shell_pool(self.shells)
+        return 0
+
+    # Returns False when the server has to stop, because the extension changed since it started
+    def handle(self, connection):
+        try:
+            request = json.loads(receive_message(connection))
+        except (OSError, ValueError):
+            return True
+
+        if request.get("version") != self.version:
+            send_message(connection, json.dumps({"stale": True}).encode())
+            return False
+
+        send_message(connection, json.dumps(self.run_job(request)).encode())
+        return True
+
+    def run_job(self, request):
+        output = io.BytesIO()
+        errors = io.StringIO()
+        status = 0
+
+        # Every job logs to its own output folder, see Options
+        for handler in logging.root.handlers[:]:
+            logging.root.removeHandler(handler)
+            handler.close()
+        os.environ.pop("DOCUMENT_PATH", None)
+        if request.get("document_path"):
+            os.environ["DOCUMENT_PATH"] = request["document_path"]
+
+        exporter = SVGStencilExporter()
+        exporter.export_server = self
+        try:
+            os.chdir(request["cwd"])
+            with contextlib.redirect_stderr(errors):
+                exporter.run(request["args"], output=output)
+        except SystemExit as error:
+            status = error.code if isinstance(error.code, int) else 1
+        except Exception:
+            errors.write(traceback.format_exc())
+            status = 1
+
+        return {
+                "status": status,
+                "stdout": base64.b64encode(output.getvalue()).decode(),
+                "stderr": errors.getvalue(),
+                }
 
 def _main():
+    # The mode is read by the same parser as the other options, e.g. --watch true and --watch=true
     exporter = SVGStencilExporter()
+    exporter.parse_arguments(sys.argv[1:])
+    options = exporter.options
+
+    if options.batch:
+        exit(BatchExport(sys.argv[1:]).run())
+
+    if Options._str_to_bool(options.watch):
+        exit(WatchExport(sys.argv[1:]).run())
+
+    if Options._str_to_bool(options.export_server):
+        exit(ExportServer(sys.argv[1:]).run())
+
     exporter.run()
     exit()
 
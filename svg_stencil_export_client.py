@@ -0,0 +1,152 @@
+#! /usr/bin/env python
+#
+# The client side of the export server of svg_stencil_export.py, see ExportServer there.
+#
+# It only uses the standard library: a run with --use-export-server is handed to the server
+# before svg_stencil_export.py imports inkex, lxml and NumPy, the server has them loaded.
+
+import argparse
+import base64
+import json
+import os
+import socket
+import sys
+import tempfile
+import time
+
+EXPORTER_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "svg_stencil_export.py")
+
+class ExportClient():
+    """Hand a run of the extension to the ExportServer, starting it when it isn't running.
+
+    Returns None from run() when the server can't be used, the extension then runs in its
+    own process as before.
+    """
+
+    def __init__(self, args):
+        self.args = args
+
+    def run(self):
+        socket_path = export_server_socket_path()
+        if socket_path is None:
+            return None
+
+        request = json.dumps({
+                "version": export_server_version(),
+                "args": self.args,
+                "cwd": os.getcwd(),
+                "document_path": os.environ.get("DOCUMENT_PATH"),
+                }).encode()
+
+        # A second try after a stale server stopped, with a fresh one
+        for attempt in range(2):
+            connection = export_server_connect(socket_path) or self.start_server(socket_path)
+            if connection is None:
+                return None
+
+            try:
+                with connection:
+                    send_message(connection, request)
+                    response = json.loads(receive_message(connection))
+            except (OSError, ValueError):
+                return None
+
+            if response.get("stale"):
+                continue
+
+            sys.stdout.buffer.write(base64.b64decode(response["stdout"]))
+            sys.stdout.flush()
+            sys.stderr.write(response["stderr"])
+            return response["status"]
+        return None
+
+    def start_server(self, socket_path):
+        command = [sys.executable, EXPORTER_FILE, "--export-server=true"]
+        command += [arg for arg in self.args if arg.startswith("--server-idle-timeout=")]
+        # Detached from this process, its session and the pipes of inkscape, the client exits
+        # long before the server
+        file_actions = [(os.POSIX_SPAWN_OPEN, fd, os.devnull, os.O_RDWR, 0) for fd in (0, 1, 2)]
+        try:
+            os.posix_spawn(sys.executable, command, os.environ, file_actions=file_actions, setsid=True)
+        except OSError:
+            return None
+
+        # The server is ready once its socket accepts connections
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            connection = export_server_connect(socket_path)
+            if connection is not None:
+                return connection
+            time.sleep(0.05)
+        return None
+
+# Read the same way as the options of the extension: --use-export-server true, or =true. The
+# batch, watch and server modes run in this process, as in _main of svg_stencil_export.py
+def wants_export_server(args):
+    parser = argparse.ArgumentParser(add_help=False, allow_abbrev=False)
+    parser.add_argument("--batch", action="append", type=str, dest="batch", default=[])
+    parser.add_argument("--watch", action="store", type=str, dest="watch", default="false")
+    parser.add_argument("--export-server", action="store", type=str, dest="export_server", default="false")
+    parser.add_argument("--use-export-server", action="store", type=str, dest="use_export_server", default="false")
+    (options, unknown) = parser.parse_known_args(args)
+    if options.batch or options.watch.lower() == 'true' or options.export_server.lower() == 'true':
+        return False
+    return options.use_export_server.lower() == 'true'
+
+# Exits with the status of the server when it ran the export, returns when the extension has to
+# run the export itself
+def hand_off(args):
+    if not wants_export_server(args):
+        return
+    status = ExportClient(args).run()
+    if status is not None:
+        sys.exit(status)
+
+# The socket is in a folder only the user can enter, other users can't hand it jobs
+def export_server_socket_path():
+    if os.name != 'posix' or not hasattr(socket, 'AF_UNIX') or not hasattr(os, 'posix_spawn'):
+        return None
+
+    folder = os.path.join(tempfile.gettempdir(), "svg-stencil-export-{}".format(os.getuid()))
+    try:
+        os.makedirs(folder, mode=0o700, exist_ok=True)
+        stat = os.stat(folder)
+    except OSError:
+        return None
+    if stat.st_uid != os.getuid() or stat.st_mode & 0o077:
+        return None
+    return os.path.join(folder, "server.sock")
+
+# A server started by an older version of the extension is replaced
+def export_server_version():
+    version = []
+    for path in (EXPORTER_FILE, os.path.abspath(__file__)):
+        stat = os.stat(path)
+        version.append("{}-{}".format(stat.st_mtime_ns, stat.st_size))
+    return "-".join(version)
+
+def export_server_connect(socket_path):
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(socket_path)
+    except OSError:
+        connection.close()
+        return None
+    return connection
+
+# Messages are sent with their length in front
+def send_message(connection, data):
+    connection.sendall(len(data).to_bytes(8, 'big') + data)
+
+def receive_message(connection):
+    length = int.from_bytes(receive_bytes(connection, 8), 'big')
+    return receive_bytes(connection, length)
+
+def receive_bytes(connection, length):
+    data = bytearray()
+    while len(data) < length:
+        chunk = connection.recv(min(length - len(data), 1 << 20))
+        if not chunk:
+            raise ConnectionError("Connection closed by the export server")
+        data += chunk
+    return bytes(data)